@@ -1,15 +1,58 @@
-from ultralytics import YOLO
 import cv2
-import math
-import shutil
+import numpy as np
+import logging
+import threading
 import time
-import os
-import sqlite3
-from datetime import datetime
+from contextlib import nullcontext
+from dataclasses import dataclass
+
+from backends import load_backend, POSE, DETECT, TORCH
+from budget import InferenceSettings
+from tracker import Tracker, START, KEYFRAME, END
+from writer import PersistenceWriter
+
+
+logger = logging.getLogger(__name__)
+
+# Раздел 'models' в config.json: веса .pt для torch, .onnx или .xml после backends.py
+MODELS = {
+    'backend': TORCH,
+    'pose': 'yolov8s-pose.pt',
+    'cigarette': 'v8s.pt',
+    'threads': 0,
+    'imgsz': 640,
+}
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def shared_model(backend, weights, task, threads=0, imgsz=640):
+    # Одна загрузка весов на процесс: все ProcVideo и камеры пользуются одним объектом.
+    # ultralytics, torch и рантаймы импортируются только здесь, чтобы не тормозить старт
+    key = (backend, weights, task, threads, imgsz)
+    with _models_lock:
+        if key not in _models:
+            _models[key] = load_backend(backend, weights, task, threads, imgsz)
+        return _models[key]
+
+
+@dataclass
+class Detection:
+    # Результат обработки одного кадра
+    results: object
+    elbow_flexion: np.ndarray
+    cigarettes_bounds: np.ndarray
+    cigarettes_scores: np.ndarray
+    smoking: np.ndarray
+    matches: np.ndarray
+    people: np.ndarray = None   # (P, 4) xyxy боксы людей
+    smokers: np.ndarray = None  # индексы людей в people для каждого региона из smoking
 
 
 class ProcVideo:
-    def __init__(self):
+    def __init__(self, association='centre', association_threshold=0.25, cigarette_roi=True, writer=None,
+                 pose_model=None, cigarette_model=None, lazy=False, warmup_size=(640, 640), models=None):
         self.right_wrist = 10
         self.left_wrist = 9
         self.right_elbow = 8
@@ -17,175 +60,313 @@ class ProcVideo:
         self.right_shoulder = 6
         self.left_shoulder = 5
         self.nose = 0
-        self.model = YOLO('yolov8s-pose.pt')
-        self.model2 = YOLO(f'v8s.pt')
-
-    def cos_angle(self, shoulder, elbow, wrist):
-        if shoulder[0] == 0 or elbow[0] == 0 or wrist[0] == 0:
-            return 0
-        dx_a = shoulder[0] - elbow[0]
-        dy_a = shoulder[1] - elbow[1]
-        dx_b = wrist[0] - elbow[0]
-        dy_b = wrist[1] - elbow[1]
-
-        dot_product = dx_a * dx_b + dy_a * dy_b
-
-        length_a = math.sqrt(dx_a ** 2 + dy_a ** 2)
-        length_b = math.sqrt(dx_b ** 2 + dy_b ** 2)
-
-        return dot_product / (length_a * length_b)
-
-    def elbow_flexion_detect(self, skeletons, boxes):
-        elbow_flexion = []
-        if skeletons.shape == (1, 0, 2):
-            return elbow_flexion
-        for i in range(len(skeletons)):
-            cos_l = self.cos_angle(skeletons[i][self.left_shoulder],
-                              skeletons[i][self.left_elbow],
-                              skeletons[i][self.left_wrist])
-            cos_r = self.cos_angle(skeletons[i][self.right_shoulder],
-                              skeletons[i][self.right_elbow],
-                              skeletons[i][self.right_wrist])
-            if 0.5 <= cos_l < 1:
-                elbow_flexion.append([int(boxes[i].xyxy[0][0]),  # x_min
-                                      skeletons[i][self.left_wrist][1],  # y_min
-                                      int(boxes[i].xyxy[0][2]),  # x_max
-                                      skeletons[i][self.nose][1]])       # y_max
-            if 0.5 <= cos_r < 1:
-                elbow_flexion.append([int(boxes[i].xyxy[0][0]),  # x_min
-                                      skeletons[i][self.right_wrist][1],  # y_min
-                                      int(boxes[i].xyxy[0][2]),  # x_max
-                                      skeletons[i][self.nose][1]])       # y_max
-        return elbow_flexion
-
-    def cigarettes_boxes(self, width, height, source):
-        bounding_boxes = []
-        labels_path = "runs/detect/predict/labels/" + source.split('.')[0] + ".txt"
-        try:
-            with open(labels_path, "r") as file:
-                lines = file.readlines()
-            for line in lines:
-                parts = line.strip().split()
-                bounding_boxes.append((float(parts[1]) * width,    # x_min
-                                       float(parts[2]) * height,   # y_min
-                                       float(parts[3]) * width,    # width
-                                       float(parts[4]) * height))  # height
-        except:
-            pass
-        return bounding_boxes
-
-    def crossing(self, man, cigarette):
-        centre_x = cigarette[0] + cigarette[2] / 2
-        centre_y = cigarette[1] + cigarette[3] / 2
-        if (man[0] <= centre_x <= man[2]) and (man[3] <= centre_y <= man[1]):
-            print("cross")
-            return True
+        self.num_keypoints = 17
+        # 'centre' — центр сигареты внутри региона руки,
+        # 'weighted' — доля площади сигареты в регионе, умноженная на её уверенность
+        self.association = association
+        self.association_threshold = association_threshold
+        # Детектор сигарет запускается только на кропах вокруг согнутых рук
+        self.cigarette_roi = cigarette_roi
+        self.roi_padding = 0.25     # доля размера региона
+        self.roi_min_padding = 32   # пикселей
+        self.nms_threshold = 0.5
+        # Запись на диск и в базу идёт в фоне, не в потоке инференса
+        # None — ProcVideo только распознаёт, сохранять некуда (например, в процессах batch.py)
+        self.writer = writer
+        # Замер шагов detect_batch: объект с методом time(name) -> контекстный менеджер, см. bench.StageTimer
+        self.timer = None
+        # Модели можно подменить заглушками (bench.py), иначе грузятся веса из models через backends.
+        # lazy=True — загрузка откладывается до load(), например в фоновом потоке окна
+        self.models = dict(MODELS, **(models or {}))
+        self.model = pose_model
+        self.model2 = cigarette_model
+        self.warmup_size = warmup_size  # (ширина, высота) пустого кадра для прогрева
+        self.ready = threading.Event()
+        if not lazy:
+            self.load()
+
+    def load(self):
+        # Загрузка весов и прогон пустого кадра, чтобы первый настоящий кадр не ждал инициализации
+        if self.ready.is_set():
+            return
+        start_time = time.time()
+        backend, threads, imgsz = self.models['backend'], self.models['threads'], self.models['imgsz']
+        if self.model is None:
+            self.model = shared_model(backend, self.models['pose'], POSE, threads, imgsz)
+        if self.model2 is None:
+            self.model2 = shared_model(backend, self.models['cigarette'], DETECT, threads, imgsz)
+        width, height = self.warmup_size
+        dummy = np.zeros((height, width, 3), dtype=np.uint8)
+        self.model.predict([dummy], conf=0.5)
+        # На пустом кадре нет рук, поэтому детектор сигарет прогреваем отдельно
+        self.model2.predict([dummy], conf=0.3)
+        self.ready.set()
+        logger.info("Models loaded and warmed up in %.1f s", time.time() - start_time)
+
+    def timed(self, name):
+        return self.timer.time(name) if self.timer is not None else nullcontext()
+
+    def cos_angles(self, shoulders, elbows, wrists):
+        # Косинусы углов в локте сразу для всех рук, массивы (..., 2)
+        vec_a = shoulders - elbows
+        vec_b = wrists - elbows
+        dot_product = (vec_a * vec_b).sum(axis=-1)
+        lengths = np.linalg.norm(vec_a, axis=-1) * np.linalg.norm(vec_b, axis=-1)
+        # Ненайденные точки YOLO возвращает как (0, 0)
+        missing = (shoulders[..., 0] == 0) | (elbows[..., 0] == 0) | (wrists[..., 0] == 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos = dot_product / lengths
+        cos[missing | (lengths == 0)] = 0
+        return cos
+
+    def elbow_flexion_detect(self, skeletons, boxes, owners=False):
+        # skeletons: (P, 17, 2) из PoseResult.keypoints, boxes: (P, 4) xyxy.
+        # Пустой кадр (1, 0, 2) превращается в (0, 17, 2).
+        # owners=True — дополнительно вернуть индекс человека для каждого региона
+        skeletons = np.asarray(skeletons, dtype=np.float32).reshape(-1, self.num_keypoints, 2)
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        shoulders = skeletons[:, [self.left_shoulder, self.right_shoulder]]
+        elbows = skeletons[:, [self.left_elbow, self.right_elbow]]
+        wrists = skeletons[:, [self.left_wrist, self.right_wrist]]
+
+        cos = self.cos_angles(shoulders, elbows, wrists)  # (P, 2): левая, правая
+        person, side = np.nonzero((cos >= 0.5) & (cos < 1))
+
+        regions = np.column_stack([np.trunc(boxes[person, 0]),         # x_min
+                                   wrists[person, side, 1],            # y_min
+                                   np.trunc(boxes[person, 2]),         # x_max
+                                   skeletons[person, self.nose, 1]])   # y_max
+        return (regions, person) if owners else regions
+
+    def cigarettes_boxes(self, results, offsets=None):
+        # results — BoxResult бэкенда для каждого кадра или кропа.
+        # offsets — левые верхние углы кропов, если детектор запускался на них
+        xyxy = [np.asarray(result.boxes, dtype=np.float32).reshape(-1, 4) for result in results]
+        scores = [np.asarray(result.scores, dtype=np.float32).reshape(-1) for result in results]
+        if offsets is not None:
+            xyxy = [boxes + np.tile(offset, 2) for boxes, offset in zip(xyxy, offsets)]
+        xyxy = np.concatenate(xyxy) if xyxy else np.empty((0, 4), dtype=np.float32)
+        scores = np.concatenate(scores) if scores else np.empty(0, dtype=np.float32)
+        bounding_boxes = np.column_stack([xyxy[:, :2],                 # x_min, y_min
+                                          xyxy[:, 2:] - xyxy[:, :2]])  # width, height
+        if len(results) > 1 and len(bounding_boxes) > 1:
+            # Кропы пересекаются, одна сигарета могла найтись несколько раз
+            keep = cv2.dnn.NMSBoxes(bounding_boxes.tolist(), scores.tolist(), 0, self.nms_threshold)
+            keep = np.asarray(keep, dtype=np.int64).reshape(-1)
+            bounding_boxes, scores = bounding_boxes[keep], scores[keep]
+        return bounding_boxes, scores
+
+    def roi_windows(self, regions, height, width, max_crops=None):
+        # Кропы вокруг регионов «запястье–нос» с запасом, в координатах кадра.
+        # max_crops — оставить столько самых крупных (ближайших к камере) кропов
+        x_min = regions[:, 0]
+        x_max = regions[:, 2]
+        y_min = np.minimum(regions[:, 1], regions[:, 3])
+        y_max = np.maximum(regions[:, 1], regions[:, 3])
+        pad_x = np.maximum((x_max - x_min) * self.roi_padding, self.roi_min_padding)
+        pad_y = np.maximum((y_max - y_min) * self.roi_padding, self.roi_min_padding)
+        windows = np.column_stack([(x_min - pad_x).clip(0, width),
+                                   (y_min - pad_y).clip(0, height),
+                                   (x_max + pad_x).clip(0, width),
+                                   (y_max + pad_y).clip(0, height)]).astype(np.int64)
+        # Левая и правая рука одного человека часто дают одинаковый кроп
+        windows = np.unique(windows.reshape(-1, 4), axis=0)
+        windows = windows[(windows[:, 2] > windows[:, 0]) & (windows[:, 3] > windows[:, 1])]
+        if max_crops is not None and len(windows) > max_crops:
+            area = (windows[:, 2] - windows[:, 0]) * (windows[:, 3] - windows[:, 1])
+            windows = windows[np.sort(np.argsort(-area, kind='stable')[:max_crops])]
+        return windows
+
+    def predict_grouped(self, model, images, conf, sizes):
+        # Кадры с разным размером входа модели идут отдельными вызовами, порядок результатов сохраняется
+        results = [None] * len(images)
+        for size in dict.fromkeys(sizes):
+            indices = [i for i, image_size in enumerate(sizes) if image_size == size]
+            for i, result in zip(indices, model.predict([images[i] for i in indices], conf=conf, imgsz=size)):
+                results[i] = result
+        return results
+
+    def detect_cigarettes(self, images, elbow_flexions, settings=None):
+        # Один вызов model2 на все кадры пачки (на каждый размер входа), результат —
+        # (боксы, уверенности) в координатах полного кадра для каждого кадра
+        settings = settings or [InferenceSettings()] * len(images)
+        if not self.cigarette_roi:
+            results = self.predict_grouped(self.model2, list(images), 0.3,
+                                           [setting.cigarette_imgsz for setting in settings])
+            return [self.cigarettes_boxes([result]) for result in results]
+
+        windows = []
+        crops = []
+        sizes = []
+        for image, elbow_flexion, setting in zip(images, elbow_flexions, settings):
+            height, width = image.shape[:2]
+            image_windows = self.roi_windows(np.asarray(elbow_flexion, dtype=np.float32).reshape(-1, 4),
+                                             height, width, setting.max_crops)
+            windows.append(image_windows)
+            crops.extend(image[y_min:y_max, x_min:x_max] for x_min, y_min, x_max, y_max in image_windows)
+            sizes.extend([setting.cigarette_imgsz] * len(image_windows))
+        # Нет согнутых рук ни на одном кадре — детектор сигарет не нужен
+        results = self.predict_grouped(self.model2, crops, 0.3, sizes) if crops else []
+
+        cigarettes = []
+        start = 0
+        for image_windows in windows:
+            end = start + len(image_windows)
+            cigarettes.append(self.cigarettes_boxes(results[start:end], image_windows[:, :2]))
+            start = end
+        return cigarettes
+
+    def association_matrix(self, regions, cigarettes, scores):
+        # Сила связи для всех пар (регион руки x сигарета) одним проходом
+        centre_x = cigarettes[None, :, 0] + cigarettes[None, :, 2] / 2
+        centre_y = cigarettes[None, :, 1] + cigarettes[None, :, 3] / 2
+        if self.association == 'centre':
+            # регион: [x_min, y запястья, x_max, y носа], нос выше запястья
+            inside = ((regions[:, [0]] <= centre_x) & (centre_x <= regions[:, [2]]) &
+                      (regions[:, [3]] <= centre_y) & (centre_y <= regions[:, [1]]))
+            return inside.astype(np.float32)
+        if self.association == 'weighted':
+            top = np.minimum(regions[:, [1]], regions[:, [3]])
+            bottom = np.maximum(regions[:, [1]], regions[:, [3]])
+            inter_w = (np.minimum(regions[:, [2]], cigarettes[None, :, 0] + cigarettes[None, :, 2]) -
+                       np.maximum(regions[:, [0]], cigarettes[None, :, 0])).clip(min=0)
+            inter_h = (np.minimum(bottom, cigarettes[None, :, 1] + cigarettes[None, :, 3]) -
+                       np.maximum(top, cigarettes[None, :, 1])).clip(min=0)
+            area = (cigarettes[:, 2] * cigarettes[:, 3]).clip(min=1e-6)
+            weights = inter_w * inter_h / area[None, :] * scores[None, :]
+            weights[weights < self.association_threshold] = 0
+            return weights.astype(np.float32)
+        raise ValueError(f"Unknown association mode: {self.association}")
+
+    def associate(self, regions, cigarettes_bounds, cigarettes_scores=None):
+        # Маска регионов, где нашлась сигарета, и индекс лучшей сигареты для каждого региона
+        cigarettes = np.asarray(cigarettes_bounds, dtype=np.float32).reshape(-1, 4)
+        if cigarettes_scores is None:
+            cigarettes_scores = np.ones(len(cigarettes), dtype=np.float32)
+        if len(regions) == 0 or len(cigarettes) == 0:
+            return np.zeros(len(regions), dtype=bool), np.zeros(len(regions), dtype=np.int64)
+
+        weights = self.association_matrix(regions, cigarettes, np.asarray(cigarettes_scores, dtype=np.float32))
+        # В режиме 'centre' argmax даёт первую подходящую сигарету, как и раньше
+        best = weights.argmax(axis=1)
+        matched = weights[np.arange(len(regions)), best] > 0
+        return matched, best
+
+    def smoking_recognition(self, elbow_flexion, cigarettes_bounds, cigarettes_scores=None):
+        # Возвращает регионы курящих и индекс сигареты, сопоставленной каждому из них
+        regions = np.asarray(elbow_flexion, dtype=np.float32).reshape(-1, 4)
+        matched, best = self.associate(regions, cigarettes_bounds, cigarettes_scores)
+        return regions[matched], best[matched]
+
+    def paint(self, image, detection, display_size=None):
+        # Рисуем только свою разметку и один раз — на уменьшенной до размера экрана копии кадра.
+        # Сам кадр не меняется и сохраняется как есть, боксы пишутся в базу
+        height, width = image.shape[:2]
+        scale = 1.0
+        if display_size is not None:
+            scale = min(display_size[0] / width, display_size[1] / height, 1.0)
+        if scale < 1.0:
+            display = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
         else:
-            return False
-
-    def smoking_recognition(self, elbow_flexion, cigarettes_bounds):
-        smoking = []
-        for man in elbow_flexion:
-            for cigarette in cigarettes_bounds:
-                if self.crossing(man, cigarette):
-                    smoking.append(man)
-                    break
-        return smoking
-
-    def save_image(self, image, camera_id):
-        if not os.path.exists('detected'):
-            os.makedirs('detected')
-
-        cam_folder = f'detected/cam_{camera_id}'
-        if not os.path.exists(cam_folder):
-            os.makedirs(cam_folder)
-
-        now = datetime.now()
-        current_time = now.strftime("%Y-%m-%d_%H-%M-%S")
-        filename = f'{current_time}.jpg'
-
-        index = 0
-        while os.path.exists(os.path.join(cam_folder, filename)):
-            index += 1
-            filename = f'{current_time}_{index}.jpg'
-
-        cv2.imwrite(os.path.join(cam_folder, filename), image)
-        height, width, _ = image.shape
-        print(height, width)
-
-        return os.path.join(cam_folder, filename)
-
-    def add_record_to_database(self, camera_id, image_path):
-        conn = sqlite3.connect('smoking_pics.db')
-        cursor = conn.cursor()
-
-        now = datetime.now()
-        current_date = now.strftime("%Y-%m-%d")
-        current_time = now.strftime("%H:%M:%S")
-
-        cursor.execute('''INSERT INTO фотографии (id_camera, date, time, path) VALUES (?, ?, ?, ?)''',
-                       (camera_id, current_date, current_time, image_path))
-
-        conn.commit()
-        conn.close()
-
-    def paint(self, im1, smoking, cigarettes_bounds, results):
-        image = results[0].plot()
-        for behaviour in smoking:
-            x_min, y_min, x_max, y_max = [int(coord) for coord in behaviour]
+            display = image.copy()
+
+        people = (np.asarray(detection.people, dtype=np.float32).reshape(-1, 4) * scale).astype(np.int32)
+        for x_min, y_min, x_max, y_max in people:
+            cv2.rectangle(display, (x_min, y_min), (x_max, y_max), (255, 128, 0), 1)
+        smoking = (np.asarray(detection.smoking, dtype=np.float32).reshape(-1, 4) * scale).astype(np.int32)
+        for x_min, y_min, x_max, y_max in smoking:
             purple_color = (255, 0, 255)  # фиолетовый
-            cv2.rectangle(image, (x_min, y_min), (x_max, y_max), purple_color, 2)  # 2 пикселя
-            cv2.rectangle(im1, (x_min, y_min), (x_max, y_max), purple_color, 2)
-        for box in cigarettes_bounds:
-            x_min, y_min, width, height = [int(coord) for coord in box]
+            cv2.rectangle(display, (x_min, y_min), (x_max, y_max), purple_color, 2)  # 2 пикселя
+        cigarettes = (np.asarray(detection.cigarettes_bounds, dtype=np.float32).reshape(-1, 4) * scale).astype(np.int32)
+        for x_min, y_min, box_width, box_height in cigarettes:
             green_color = (0, 255, 0)
-            cv2.rectangle(image, (x_min, y_min), (x_min + width, y_min + height), green_color, 2)
-        if len(smoking) > 0:
-            print("smoking")
-            path = self.save_image(im1, 0)
-            self.add_record_to_database(0, path)
-
-        return image
-
-    def frame(self, source):
-        if os.path.exists('runs/detect/predict'):
-            shutil.rmtree('runs/detect/predict')
-        if os.path.exists('runs/detect/predict2'):
-            shutil.rmtree('runs/detect/predict2')
-        results = self.model(source, conf=0.5, save=False)
-        people = results[0].keypoints.xy.cpu().numpy()
-        boxes = results[0].boxes
-        elbow_flexion = self.elbow_flexion_detect(people, boxes)
-        if len(elbow_flexion) > 0:
-            print("elbow")
-
-        self.model2.predict(source=source, conf=0.3, save=False, save_txt=True)
-
-        image = cv2.imread(source)
-        height, width, _ = image.shape
-        cigarettes_bounds = self.cigarettes_boxes(width, height, source)
-        if len(cigarettes_bounds) > 0:
-            print("cigarette")
-        smoking = self.smoking_recognition(elbow_flexion, cigarettes_bounds)
-
-        return self.paint(image, smoking, cigarettes_bounds, results)
+            cv2.rectangle(display, (x_min, y_min), (x_min + box_width, y_min + box_height), green_color, 2)
+
+        return display
+
+    def persist_event(self, im1, action, camera_id=0, timestamp=None):
+        # Одна запись на событие и несколько ключевых кадров вместо кадра на каждый кадр видео.
+        # timestamp — время захвата кадра, то же, что трекер ставит в начало и конец события.
+        # Без writer ProcVideo только распознаёт
+        if self.writer is None:
+            return
+        if action.kind in (START, KEYFRAME):
+            timestamp = time.time() if timestamp is None else timestamp
+            path = self.writer.new_path(camera_id, timestamp)
+            if action.kind == START:
+                # Строка события встаёт в очередь раньше кадров, они ссылаются на её id
+                self.writer.add_event(camera_id, action.event, path)
+            self.writer.save_image(im1, camera_id, timestamp, boxes=action.box, confidence=action.event.confidence,
+                                   event=action.event, path=path)
+        elif action.kind == END:
+            self.writer.update_event(action.event)
+
+    def detect_batch(self, images, settings=None):
+        # Кадры со всех камер проходят через каждую модель одним батчем.
+        # settings — InferenceSettings для каждого кадра (см. budget.BudgetController), None — по умолчанию.
+        # Модели уменьшают кадр сами, все координаты результата — в полном кадре
+        if len(images) == 0:
+            return []
+        settings = settings or [InferenceSettings()] * len(images)
+        with self.timed('pose'):
+            results = self.predict_grouped(self.model, list(images), 0.5,
+                                           [setting.pose_imgsz for setting in settings])
+        people_boxes = []
+        elbow_flexions = []
+        owners = []
+        with self.timed('elbow'):
+            for result in results:
+                people = result.keypoints
+                boxes = np.asarray(result.boxes, dtype=np.float32).reshape(-1, 4)
+                regions, person = self.elbow_flexion_detect(people, boxes, owners=True)
+                people_boxes.append(boxes)
+                elbow_flexions.append(regions.astype(np.float32))
+                owners.append(person)
+
+        detections = []
+        with self.timed('cigarettes'):
+            cigarettes = self.detect_cigarettes(images, elbow_flexions, settings)
+        for i, (cigarettes_bounds, cigarettes_scores) in enumerate(cigarettes):
+            with self.timed('recognition'):
+                matched, best = self.associate(elbow_flexions[i], cigarettes_bounds, cigarettes_scores)
+            detections.append(Detection([results[i]], elbow_flexions[i], cigarettes_bounds, cigarettes_scores,
+                                        elbow_flexions[i][matched], best[matched],
+                                        people_boxes[i], owners[i][matched]))
+        return detections
+
+    def detect(self, image):
+        return self.detect_batch([image])[0]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
 
     def videofun(self):
         cap = cv2.VideoCapture(0)
+        # Как в Pipeline: трекер превращает детекции в события, сохраняются только их кадры
+        tracker = Tracker()
         while True:
-            _, kadr = cap.read()
-            cv2.imwrite("frame.jpg", kadr)
+            ret, kadr = cap.read()
+            if not ret:
+                continue
             start_time = time.time()
-            res = self.frame("frame.jpg")
+            detection = self.detect(kadr)
+            res = self.paint(kadr, detection)
+            for action in tracker.update(detection.people, detection.smokers, start_time):
+                self.persist_event(kadr, action, timestamp=start_time)
             end_time = time.time()
             execution_time = end_time - start_time
-            print(f"Время выполнения функции: {execution_time} секунд")
+            logger.debug("Время выполнения функции: %.3f секунд", execution_time)
             cv2.imshow("cam", res)
 
             if cv2.waitKey(30) == ord('q'):
                 break
+        for action in tracker.flush():
+            self.persist_event(None, action)
+        self.close()
 
 
 if __name__ == "__main__":
-    procv = ProcVideo()
+    logging.basicConfig(level=logging.DEBUG)
+    procv = ProcVideo(writer=PersistenceWriter())
     procv.videofun()
@@ -1,94 +1,114 @@
-import sys
-import time
-import os
-import cv2
-import sqlite3
-from PySide6.QtCore import Qt, QThread, Signal, Slot, QDate, QDateTime
+import logging
+from PySide6.QtCore import Qt, QThread, Signal, Slot, QDate, QDateTime, QSize, QThreadPool
 from PySide6.QtGui import QImage, QPixmap
 from PySide6.QtWidgets import (QApplication, QHBoxLayout, QLabel, QMainWindow, QPushButton,
-                               QVBoxLayout, QWidget, QScrollArea, QSizePolicy)
+                               QVBoxLayout, QWidget, QSizePolicy, QListView, QAbstractItemView)
 from alg import ProcVideo
-from PySide6.QtWidgets import QDialog, QDateEdit, QDialogButtonBox, QMessageBox
+from pipeline import Pipeline
+from PySide6.QtWidgets import QDialog, QDateEdit, QDialogButtonBox, QMessageBox, QComboBox
+from config import load_config
+from writer import PersistenceWriter
+from thumbnails import ThumbnailStore
+from pixmaps import PixmapCache, ImageLoader, ImageLoaderSignals
+from gallery import DetectionListModel
+from metrics import MetricsServer, StageMetrics
+from workers import WorkerPool, slot_bytes
+from storage import StorageMaintenance, display_name
+
+
+logger = logging.getLogger(__name__)
 
 
 class Thread(QThread):
-    updateFrame = Signal(QImage)
+    updateFrame = Signal(int, object)  # camera id, BGR frame already at display size (ndarray)
 
-    def __init__(self, procv, parent=None):
+    def __init__(self, procv, config, display_size, pool=None, parent=None):
         QThread.__init__(self, parent)
         self.status = True
-        self.cap = True
-        self.current_frame = None  # Store the current frame
+        self.current_frames = {}  # Store the current frame of every camera
         self.procv = procv
+        self.config = config
+        self.display_size = display_size
+        self.pool = pool
+        self.pipeline = None
 
     def run(self):
-        self.cap = cv2.VideoCapture(0, cv2.CAP_DSHOW)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
+        # Capture, inference, painting and saving run in their own pipeline stages,
+        # this thread only hands finished frames over to the GUI thread
+        self.pipeline = Pipeline.from_config(self.procv, self.config, self.display_size, self.pool)
+        self.pipeline.start()
         while self.status:
-            ret, kadr = self.cap.read()
-            if not ret:
+            packet = self.pipeline.get(timeout=0.1)
+            if packet is None:
                 continue
 
-            # Reading the image in RGB to display it
-            cv2.imwrite("frame.jpg", kadr)
-            res = self.procv.frame("frame.jpg")
-            color_frame = cv2.cvtColor(res, cv2.COLOR_BGR2RGB)
-
-            # Creating QImage
-            h, w, ch = color_frame.shape
-            img = QImage(color_frame.data, w, h, ch * w, QImage.Format_RGB888)
+            # Store the current frame for resizing and camera switching
+            self.current_frames[packet.camera_id] = packet.display
 
-            # Store the current frame for resizing
-            self.current_frame = img
+            # The ndarray travels with the signal, so its buffer stays alive
+            # until the GUI thread has copied it into a QPixmap
+            self.updateFrame.emit(packet.camera_id, packet.display)
+        self.pipeline.stop()
 
-            # Emit signal
-            self.updateFrame.emit(img)
-            # time.sleep(0.05)  # Add a short delay to control frame rate
-        sys.exit(-1)
+    def set_display_size(self, display_size):
+        self.display_size = display_size
+        if self.pipeline:
+            self.pipeline.set_display_size(display_size)
 
     def stop(self):
         self.status = False
 
 
+class ModelLoader(QThread):
+    # Loads and warms up the models off the GUI thread, the window stays responsive meanwhile
+    ready = Signal()
+    failed = Signal(str)
+
+    def __init__(self, load, parent=None):
+        QThread.__init__(self, parent)
+        self.load = load  # ProcVideo.load or WorkerPool.wait_ready
+
+    def run(self):
+        try:
+            self.load()
+        except Exception as error:
+            logger.exception("Failed to load models")
+            self.failed.emit(str(error))
+            return
+        self.ready.emit()
+
+
 class ImageWidget(QWidget):
     imageClicked = Signal(int)  # Signal to indicate that an image has been clicked
 
-    def __init__(self, parent=None):
+    def __init__(self, thumbnails, cache, parent=None):
         super().__init__(parent)
         self.layout = QVBoxLayout(self)
-        self.scroll_area = QScrollArea(self)
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area_content = QWidget()
-        self.scroll_area_layout = QVBoxLayout(self.scroll_area_content)
-        self.scroll_area.setWidget(self.scroll_area_content)
-        self.layout.addWidget(self.scroll_area)
+        # Rows come from the database page by page, only visible items get pixmaps
+        self.model = DetectionListModel(thumbnails, cache, parent=self)
+        self.view = QListView(self)
+        self.view.setModel(self.model)
+        self.view.setIconSize(QSize(320, 180))
+        self.view.setUniformItemSizes(True)
+        self.view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.view.clicked.connect(self.handle_image_click)
+        self.layout.addWidget(self.view)
         self.setLayout(self.layout)
-        self.image_paths = []  # Store original image paths
-
-    def add_image(self, image_path):
-        self.image_paths.append(image_path)  # Store the original image path
 
-        label = QLabel()
-        pixmap = QPixmap(image_path)
+    @property
+    def image_paths(self):
+        return self.model.image_paths()
 
-        # Scale the image to fill the width of the scroll area
-        pixmap_scaled = pixmap.scaledToWidth(self.scroll_area.width())
-
-        label.setPixmap(pixmap_scaled)
-        label.setScaledContents(True)  # Scale the contents of the label
-        # Connect the clicked signal of the label to the slot for handling image clicks
-        label.mousePressEvent = lambda event, index=self.scroll_area_layout.count(): self.handle_image_click(index)
-        self.scroll_area_layout.addWidget(label)
-        print(f"Image added to layout: {image_path}")  # Отладочная информация
+    def show_images(self, camera_id, start_date=None, end_date=None):
+        self.model.set_filter(camera_id, start_date, end_date)
 
     def handle_image_click(self, index):
         # Emit the imageClicked signal with the index of the clicked image
-        self.imageClicked.emit(index)
+        self.imageClicked.emit(index.row())
 
 
 class CarouselWindow(QDialog):
-    def __init__(self, image_paths, start_index):
+    def __init__(self, image_paths, start_index, cache, pool, prefetch=2):
         super().__init__()
 
         self.setWindowTitle("Image Carousel")
@@ -96,6 +116,13 @@ class CarouselWindow(QDialog):
 
         self.image_paths = image_paths
         self.current_index = start_index
+        # Decoded originals are shared with the main window, resizes only rescale them
+        self.cache = cache
+        self.pool = pool
+        self.prefetch = prefetch  # neighbours decoded ahead on each side
+        self.pending = set()
+        self.signals = ImageLoaderSignals()
+        self.signals.loaded.connect(self.on_loaded)
 
         self.image_label = QLabel()
         self.image_label.setAlignment(Qt.AlignCenter)
@@ -125,10 +152,36 @@ class CarouselWindow(QDialog):
         self.setLayout(layout)
         self.setFixedSize(800, 600)  # Set the fixed window size
 
-    def update_image(self):
-        pixmap = QPixmap(self.image_paths[self.current_index])
+    def request(self, path):
+        if path in self.cache or path in self.pending:
+            return
+        self.pending.add(path)
+        self.pool.start(ImageLoader(self.signals, path))
+
+    def on_loaded(self, path, image):
+        self.pending.discard(path)
+        self.cache.put(path, QPixmap.fromImage(image))
+        if path == self.image_paths[self.current_index]:
+            if image.isNull():
+                self.image_label.setText("Файл не найден")
+            else:
+                self.show_current()
+
+    def show_current(self):
+        pixmap = self.cache.get(self.image_paths[self.current_index])
+        if pixmap is None:
+            self.image_label.setText("Загрузка...")
+            return
         self.image_label.setPixmap(pixmap.scaled(self.image_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
-        self.text_label.setText(os.path.basename(self.image_paths[self.current_index]))  # Display file name
+
+    def update_image(self):
+        self.text_label.setText(display_name(self.image_paths[self.current_index]))  # Display file name
+        self.request(self.image_paths[self.current_index])
+        self.show_current()
+        # Prefetch the neighbours so Next/Previous do not wait for the disk
+        for offset in range(1, self.prefetch + 1):
+            self.request(self.image_paths[(self.current_index + offset) % len(self.image_paths)])
+            self.request(self.image_paths[(self.current_index - offset) % len(self.image_paths)])
 
     def show_previous_image(self):
         self.current_index = (self.current_index - 1) % len(self.image_paths)
@@ -139,7 +192,7 @@ class CarouselWindow(QDialog):
         self.update_image()
 
     def resizeEvent(self, event):
-        self.update_image()
+        self.show_current()
         super().resizeEvent(event)
 
 
@@ -185,7 +238,42 @@ class Window(QMainWindow):
         super().__init__()
         # Title and dimensions
         self.setWindowTitle("Smoking detection")
-        self.procv = ProcVideo()
+        self.config = load_config()
+        self.thumbnails = ThumbnailStore(**self.config['thumbnails'])
+        self.thumbnail_cache = PixmapCache(self.config['gallery']['cache_bytes'])
+        # Full-size images for the carousel, kept between openings
+        self.image_cache = PixmapCache(self.config['gallery']['image_cache_bytes'])
+        self.image_pool = QThreadPool(self)
+        self.image_pool.setMaxThreadCount(2)
+        # Models are loaded in the background by ModelLoader, see models_ready
+        self.procv = ProcVideo(writer=PersistenceWriter(thumbnails=self.thumbnails, **self.config['writer']),
+                               lazy=True, models=self.config['models'], **self.config['detector'])
+        # With worker processes the models live there, this ProcVideo only paints and saves
+        self.pool = None
+        workers = self.config['workers']
+        if workers['processes'] > 0:
+            self.pool = WorkerPool(workers['processes'], workers['threads'],
+                                   workers['processes'] * len(self.config['cameras']),
+                                   slot_bytes(self.config['cameras']), self.config['models'],
+                                   self.config['detector'])
+        # Old days are packed into archives and expired in the background, see storage.StorageMaintenance
+        self.maintenance = None
+        retention = self.config['retention']
+        if retention['enabled']:
+            self.maintenance = StorageMaintenance(self.procv.writer.db_path, self.procv.writer.root,
+                                                  self.config['cameras'], thumbnails=self.thumbnails,
+                                                  **{key: value for key, value in retention.items()
+                                                     if key != 'enabled'})
+            self.maintenance.start()
+        self.metrics_server = None
+        metrics = self.config['metrics']
+        if metrics['enabled']:
+            self.procv.timer = StageMetrics()
+            try:
+                self.metrics_server = MetricsServer(metrics['host'], metrics['port']).start()
+                logger.info("Metrics on http://%s:%d/metrics", metrics['host'], self.metrics_server.port)
+            except OSError:
+                logger.warning("Metrics port %d is busy, endpoint disabled", metrics['port'])
 
         # Create a label for the display camera
         self.label = QLabel(self)
@@ -201,8 +289,15 @@ class Window(QMainWindow):
         self.button1 = QPushButton("Start")
         self.button2 = QPushButton("Stop")
 
+        # Camera selector: which feed is shown and whose photos are listed
+        self.camera_box = QComboBox()
+        for camera in self.config['cameras']:
+            self.camera_box.addItem(f"Камера {camera['id']}", camera['id'])
+        self.camera_box.currentIndexChanged.connect(self.change_camera)
+
         # Left layout
         buttons_layout = QHBoxLayout()  # Horizontal layout for buttons
+        buttons_layout.addWidget(self.camera_box)
         buttons_layout.addWidget(self.button1)
         buttons_layout.addWidget(self.button2)
 
@@ -212,9 +307,9 @@ class Window(QMainWindow):
 
         # Right layout (empty)
         right_layout = QVBoxLayout()
-        self.image_widget = ImageWidget()
+        self.image_widget = ImageWidget(self.thumbnails, self.thumbnail_cache)
         self.image_widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)  # Expand the image widget
-        self.image_widget.scroll_area.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)  # Expand the scroll area
+        self.image_widget.view.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)  # Expand the list view
         right_layout.addWidget(self.image_widget)
 
         # Add "Show Photos" button to the top of the right layout
@@ -241,9 +336,18 @@ class Window(QMainWindow):
         self.button1.clicked.connect(self.start)
         self.button2.clicked.connect(self.stop)
         self.button2.setEnabled(False)  # Initially disable the "Stop" button
+        # "Start" waits for the models, the gallery is usable right away
+        self.button1.setEnabled(False)
+        self.button1.setText("Loading models...")
 
         # Thread instance
         self.th = None
+        self.models_loaded = False
+
+        self.loader = ModelLoader(self.pool.wait_ready if self.pool else self.procv.load, self)
+        self.loader.ready.connect(self.models_ready)
+        self.loader.failed.connect(self.models_failed)
+        self.loader.start()
 
         # Connect the imageClicked signal from ImageWidget to the show_carousel slot
         self.image_widget.imageClicked.connect(self.show_carousel)
@@ -252,18 +356,25 @@ class Window(QMainWindow):
         # Call the parent class resizeEvent to handle standard resizing behavior
         super().resizeEvent(event)
         # Update the video label size while maintaining aspect ratio
-        if self.th and self.th.cap.isOpened():
+        if self.th and self.th.isRunning():
             self.update_video_size()
 
+    def display_size(self):
+        return self.label.width(), self.label.height()
+
     def update_video_size(self):
-        # Получение размера метки, где отображается видео
-        label_size = self.label.size()
+        # Следующие кадры будут уменьшены под новый размер ещё в конвейере
+        self.th.set_display_size(self.display_size())
+
+        current_frame = self.th.current_frames.get(self.camera_id())
+        if current_frame is not None:
+            self.show_frame(current_frame)
 
-        # Изменение размера видео метки с сохранением пропорций
-        if self.th.current_frame:
-            pixmap = QPixmap.fromImage(self.th.current_frame)
-            pixmap_resized = pixmap.scaled(label_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.label.setPixmap(pixmap_resized)
+    def show_frame(self, frame):
+        # BGR888 Qt понимает без cvtColor; QPixmap.fromImage копирует буфер, пока frame жив
+        h, w = frame.shape[:2]
+        image = QImage(frame.data, w, h, frame.strides[0], QImage.Format_BGR888)
+        self.label.setPixmap(QPixmap.fromImage(image))
 
     def set_default_image(self):
         default_image = QImage(640, 360, QImage.Format_RGB888)
@@ -271,92 +382,93 @@ class Window(QMainWindow):
         self.label.setPixmap(QPixmap.fromImage(default_image))
 
     def load_images_from_folder(self):
-        folder_path = "detected/cam_0"
-
-        # Очистка текущих изображений в виджете ImageWidget
-        for i in reversed(range(self.image_widget.scroll_area_layout.count())):
-            widget_to_remove = self.image_widget.scroll_area_layout.itemAt(i).widget()
-            self.image_widget.scroll_area_layout.removeWidget(widget_to_remove)
-            widget_to_remove.setParent(None)
-        self.image_widget.image_paths.clear()
-
-        for filename in os.listdir(folder_path):
-            if filename.endswith(('.jpg', '.jpeg', '.png')):
-                image_path = os.path.join(folder_path, filename)
-                print(image_path)
-                self.image_widget.add_image(image_path)
+        # Все кадры выбранной камеры из базы, без os.listdir по папке
+        self.image_widget.show_images(self.camera_id())
 
     @Slot()
     def start(self):
-        print("Starting...")
+        logger.info("Starting...")
         self.button1.setEnabled(False)  # Disable the "Start" button
         self.button2.setEnabled(True)  # Enable the "Stop" button
 
-        self.th = Thread(self.procv)
+        self.th = Thread(self.procv, self.config, self.display_size(), self.pool)
         self.th.updateFrame.connect(self.set_image)
+        self.th.finished.connect(self.stopped)
         self.th.start()
 
     @Slot()
     def stop(self):
-        print("Stopping...")
+        logger.info("Stopping...")
         self.button2.setEnabled(False)  # Disable the "Stop" button
-        self.button1.setEnabled(True)  # Enable the "Start" button
+        # "Start" comes back in stopped(): the thread still joins the stages and flushes the writer
         if self.th:
             self.th.stop()  # Stop the thread
 
-    @Slot(QImage)
-    def set_image(self, image):
-        self.th.current_frame = image  # Обновление текущего кадра
-        pixmap = QPixmap.fromImage(image)
-        label_size = self.label.size()
+    @Slot()
+    def stopped(self):
+        self.button2.setEnabled(False)
+        self.button1.setEnabled(self.models_loaded)
 
-        # Ограничение высоты изображения до 1080 пикселей
-        if label_size.height() > 1080:
-            label_size.setHeight(1080)
+    @Slot()
+    def models_ready(self):
+        self.models_loaded = True
+        self.button1.setText("Start")
+        self.button1.setEnabled(not (self.th and self.th.isRunning()))
+
+    @Slot(str)
+    def models_failed(self, message):
+        self.button1.setText("Start")
+        QMessageBox.critical(self, "Smoking detection", f"Не удалось загрузить модели: {message}")
+
+    def closeEvent(self, event):
+        # Дописываем очередь сохранения перед выходом
+        if self.th:
+            self.th.stop()
+            self.th.wait()
+        # Загрузку весов не прервать, дожидаемся её, чтобы поток не остался висеть
+        self.loader.wait()
+        self.procv.close()
+        if self.pool:
+            self.pool.close()
+        if self.metrics_server:
+            self.metrics_server.close()
+        if self.maintenance:
+            self.maintenance.stop()
+            self.maintenance.join(5)
+        super().closeEvent(event)
+
+    def camera_id(self):
+        return self.camera_box.currentData()
+
+    @Slot(int)
+    def change_camera(self, index):
+        if self.th and self.th.isRunning():
+            self.update_video_size()
+        else:
+            self.set_default_image()
 
-        pixmap_resized = pixmap.scaled(label_size, Qt.KeepAspectRatio)
-        self.label.setPixmap(pixmap_resized)
+    @Slot(int, object)
+    def set_image(self, camera_id, frame):
+        if camera_id != self.camera_id():
+            return  # кадр другой камеры, сейчас не показывается
+        self.show_frame(frame)
 
     def show_carousel(self, index):
         image_paths = self.image_widget.image_paths
-        carousel_window = CarouselWindow(image_paths, index)
+        carousel_window = CarouselWindow(image_paths, index, self.image_cache, self.image_pool,
+                                         self.config['gallery']['prefetch'])
         carousel_window.resize(800, 600)  # Set the desired window size
         carousel_window.exec()
 
-    def get_images_by_period(self, start_date, end_date):
-        conn = sqlite3.connect('smoking_pics.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''SELECT path FROM фотографии WHERE date BETWEEN ? AND ?''',
-                       (start_date, end_date))
-        image_paths = [row[0].replace('\\', '/') for row in cursor.fetchall()]
-
-        conn.close()
-        return image_paths
-
     def show_select_period_dialog(self):
         dialog = SelectPeriodDialog(self)
         if dialog.exec() == QDialog.Accepted:
             period = dialog.get_period()
             if period is not None:
                 start, end = period
-                print("Selected period:", start, end)
-
-                # Получение изображений из базы данных по выбранному периоду
-                image_paths = self.get_images_by_period(start, end)
-
-                print("Image paths:", image_paths)  # Отладочная информация
-
-                # Очистка текущих изображений в виджете ImageWidget
-                for i in reversed(range(self.image_widget.scroll_area_layout.count())):
-                    widget_to_remove = self.image_widget.scroll_area_layout.itemAt(i).widget()
-                    self.image_widget.scroll_area_layout.removeWidget(widget_to_remove)
-                    widget_to_remove.setParent(None)
-                self.image_widget.image_paths.clear()
+                logger.debug("Selected period: %s %s", start, end)
 
-                # Добавление новых изображений в виджет
-                for image_path in image_paths:
-                    self.image_widget.add_image(image_path)
-                    print(f"Added image: {image_path}")  # Отладочная информация
+                # Изображения из базы данных по выбранному периоду, подгружаются по мере прокрутки
+                self.image_widget.show_images(self.camera_id(), start, end)
             else:
-                print("Period selection canceled.")
+                logger.debug("Period selection canceled.")
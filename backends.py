@@ -0,0 +1,264 @@
+import argparse
+import logging
+import os
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+POSE = 'pose'
+DETECT = 'detect'
+
+TORCH = 'torch'
+ONNX = 'onnx'
+OPENVINO = 'openvino'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+@dataclass
+class PoseResult:
+    # Люди на одном кадре, координаты кадра
+    keypoints: np.ndarray  # (P, 17, 2) xy, ненайденные точки — (0, 0), как в ultralytics
+    boxes: np.ndarray      # (P, 4) xyxy
+    scores: np.ndarray     # (P,)
+
+
+@dataclass
+class BoxResult:
+    # Объекты на одном кадре (или кропе)
+    boxes: np.ndarray   # (N, 4) xyxy
+    scores: np.ndarray  # (N,)
+
+
+def empty_pose():
+    return PoseResult(np.zeros((0, 17, 2), np.float32), np.zeros((0, 4), np.float32), np.zeros(0, np.float32))
+
+
+class TorchBackend:
+    # ultralytics YOLO на PyTorch: исходные .pt без конвертации
+    def __init__(self, weights, task, threads=0, imgsz=640):
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        from ultralytics import YOLO
+        self.model = YOLO(weights)
+        self.task = task
+        self.imgsz = imgsz
+
+    def predict(self, images, conf, imgsz=None):
+        results = self.model(list(images), conf=conf, imgsz=imgsz or self.imgsz, save=False, verbose=False)
+        if self.task == POSE:
+            return [PoseResult(result.keypoints.xy.cpu().numpy().reshape(-1, 17, 2),
+                               result.boxes.xyxy.cpu().numpy().reshape(-1, 4),
+                               result.boxes.conf.cpu().numpy().reshape(-1)) for result in results]
+        return [BoxResult(result.boxes.xyxy.cpu().numpy().reshape(-1, 4),
+                          result.boxes.conf.cpu().numpy().reshape(-1)) for result in results]
+
+
+def letterbox(image, size):
+    # Как в ultralytics: уменьшение с сохранением пропорций и серые поля 114 по краям
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width)
+    new_width, new_height = round(width * ratio), round(height * ratio)
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    pad_x, pad_y = (size - new_width) / 2, (size - new_height) / 2
+    top, left = round(pad_y - 0.1), round(pad_x - 0.1)
+    image = cv2.copyMakeBorder(image, top, size - new_height - top, left, size - new_width - left,
+                               cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return image, ratio, (left, top)
+
+
+def to_blob(images):
+    # BGR uint8 HWC -> RGB float32 NCHW 0..1
+    return np.ascontiguousarray(np.stack(images)[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32) / 255
+
+
+class ExportedBackend:
+    # Общие для ONNX Runtime и OpenVINO предобработка и разбор выхода YOLOv8:
+    # (B, 4 + классы, N) для детектора, (B, 4 + 1 + 17 * 3, N) для позы
+    iou_threshold = 0.7
+    max_det = 300
+    keypoint_threshold = 0.5
+
+    def __init__(self, task, imgsz=640):
+        self.task = task
+        self.imgsz = imgsz
+        self.batch = None  # None — динамический батч, иначе модель принимает ровно столько кадров
+        self.fixed_size = False  # вход модели задан при экспорте, другой imgsz не подать
+
+    def run(self, blob):
+        raise NotImplementedError
+
+    def predict(self, images, conf, imgsz=None):
+        images = list(images)
+        size = self.imgsz if self.fixed_size or not imgsz else imgsz
+        prepared = [letterbox(image, size) for image in images]
+        blobs = [to_blob([image for image, _, _ in prepared])] if self.batch is None else \
+            [to_blob([image]) for image, _, _ in prepared]
+        output = np.concatenate([self.run(blob) for blob in blobs])
+        return [self.decode(prediction, ratio, pad, image.shape[:2], conf)
+                for prediction, (_, ratio, pad), image in zip(output, prepared, images)]
+
+    def decode(self, prediction, ratio, pad, shape, conf):
+        prediction = prediction.T  # (N, C)
+        if self.task == POSE:
+            scores = prediction[:, 4]
+        else:
+            scores = prediction[:, 4:].max(axis=1)
+        keep = scores > conf
+        prediction, scores = prediction[keep], scores[keep]
+        if len(prediction) == 0:
+            return empty_pose() if self.task == POSE else BoxResult(np.zeros((0, 4), np.float32),
+                                                                    np.zeros(0, np.float32))
+        centre, size = prediction[:, :2], prediction[:, 2:4]
+        boxes = np.column_stack([centre - size / 2, size])  # xywh для NMSBoxes
+        keep = cv2.dnn.NMSBoxes(boxes.tolist(), scores.tolist(), conf, self.iou_threshold, top_k=self.max_det)
+        keep = np.asarray(keep, dtype=np.int64).reshape(-1)
+        prediction, scores, boxes = prediction[keep], scores[keep], boxes[keep]
+
+        height, width = shape
+        offset = np.array(pad, np.float32)
+        xyxy = np.column_stack([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]])
+        xyxy = (xyxy - np.tile(offset, 2)) / ratio
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, width)
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, height)
+        if self.task != POSE:
+            return BoxResult(xyxy.astype(np.float32), scores.astype(np.float32))
+
+        keypoints = prediction[:, 5:].reshape(-1, 17, 3)
+        xy = (keypoints[..., :2] - offset) / ratio
+        xy[keypoints[..., 2] < self.keypoint_threshold] = 0
+        return PoseResult(xy.astype(np.float32), xyxy.astype(np.float32), scores.astype(np.float32))
+
+
+class OnnxBackend(ExportedBackend):
+    def __init__(self, weights, task, threads=0, imgsz=640):
+        super().__init__(task, imgsz)
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads  # 0 — по числу ядер
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(weights, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        if isinstance(model_input.shape[0], int):
+            self.batch = model_input.shape[0]
+        if isinstance(model_input.shape[2], int):
+            self.imgsz = model_input.shape[2]
+            self.fixed_size = True
+
+    def run(self, blob):
+        return self.session.run(None, {self.input_name: blob})[0]
+
+
+class OpenVinoBackend(ExportedBackend):
+    def __init__(self, weights, task, threads=0, imgsz=640):
+        super().__init__(task, imgsz)
+        import openvino as ov
+        core = ov.Core()
+        if os.path.isdir(weights):
+            # Папка *_openvino_model от ultralytics
+            weights = next(os.path.join(weights, name) for name in os.listdir(weights) if name.endswith('.xml'))
+        model = core.read_model(weights)
+        shape = model.input(0).get_partial_shape()
+        if shape[0].is_static:
+            self.batch = shape[0].get_length()
+        if shape[2].is_static:
+            self.imgsz = shape[2].get_length()
+            self.fixed_size = True
+        config = {'PERFORMANCE_HINT': 'LATENCY'}
+        if threads:
+            config['INFERENCE_NUM_THREADS'] = threads
+        self.compiled = core.compile_model(model, 'CPU', config)
+        self.output = self.compiled.output(0)
+
+    def run(self, blob):
+        return self.compiled([blob])[self.output]
+
+
+BACKENDS = {TORCH: TorchBackend, ONNX: OnnxBackend, OPENVINO: OpenVinoBackend}
+
+
+def load_backend(backend, weights, task, threads=0, imgsz=640):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    logger.info("Loading %s with %s backend", weights, backend)
+    return BACKENDS[backend](weights, task, threads, imgsz)
+
+
+def calibration_images(folder, imgsz, limit=300):
+    # Кадры для INT8-калибровки, с той же предобработкой, что и при инференсе
+    names = sorted(name for name in os.listdir(folder) if name.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+    for name in names:
+        image = cv2.imread(os.path.join(folder, name))
+        if image is not None:
+            yield to_blob([letterbox(image, imgsz)[0]])
+
+
+def quantize_onnx(model_path, output_path, folder, imgsz, limit=300):
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class Reader(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.input_name = input_name
+            self.blobs = calibration_images(folder, imgsz, limit)
+
+        def get_next(self):
+            blob = next(self.blobs, None)
+            return None if blob is None else {self.input_name: blob}
+
+    import onnxruntime as ort
+    input_name = ort.InferenceSession(model_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    quantize_static(model_path, output_path, Reader(input_name), quant_format=QuantFormat.QDQ,
+                    per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    return output_path
+
+
+def quantize_openvino(model_path, output_path, folder, imgsz, limit=300):
+    import nncf
+    import openvino as ov
+    model = ov.Core().read_model(model_path)
+    dataset = nncf.Dataset(list(calibration_images(folder, imgsz, limit)))
+    quantized = nncf.quantize(model, dataset, preset=nncf.QuantizationPreset.MIXED, subset_size=limit)
+    ov.save_model(quantized, output_path)
+    return output_path
+
+
+def export(weights, backend, imgsz=640, half=False, calibration=None, limit=300):
+    # .pt -> .onnx или папка OpenVINO; с calibration — дополнительно INT8-версия рядом.
+    # Возвращает путь, который нужно указать в config.json
+    from ultralytics import YOLO
+    model = YOLO(weights)
+    if backend == ONNX:
+        # Динамический батч: все камеры проходят одним вызовом
+        path = model.export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+        if calibration:
+            path = quantize_onnx(path, path.replace('.onnx', '_int8.onnx'), calibration, imgsz, limit)
+    elif backend == OPENVINO:
+        folder = model.export(format='openvino', imgsz=imgsz, dynamic=True, half=half)
+        path = next(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith('.xml'))
+        if calibration:
+            path = quantize_openvino(path, path.replace('.xml', '_int8.xml'), calibration, imgsz, limit)
+    else:
+        raise ValueError(f"Nothing to export for backend: {backend}")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Экспорт моделей YOLO для ONNX Runtime / OpenVINO")
+    parser.add_argument('weights', nargs='+', help="исходные .pt, например yolov8s-pose.pt v8s.pt")
+    parser.add_argument('--backend', choices=[ONNX, OPENVINO], default=OPENVINO)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--half', action='store_true', help="FP16-веса (только OpenVINO)")
+    parser.add_argument('--calibration', help="папка с кадрами для INT8-квантования")
+    parser.add_argument('--limit', type=int, default=300, help="сколько кадров брать для калибровки")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for weights in args.weights:
+        print(f"{weights} -> {export(weights, args.backend, args.imgsz, args.half, args.calibration, args.limit)}")
@@ -0,0 +1,338 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from alg import ProcVideo
+from config import load_config
+from db import DB_PATH
+from thumbnails import ThumbnailStore
+from tracker import Tracker, START, KEYFRAME, END, SmokingEvent
+from storage import day_folder, parse_locator, remove_file
+from writer import PersistenceWriter, format_datetime
+
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.m4v', '.ts')
+
+
+@dataclass
+class Job:
+    # Кусок работы для одного процесса: отрезок видео или пачка картинок
+    job_id: str
+    source: str
+    start: int                 # первый кадр (для видео) или индекс в files
+    end: int                   # не включая
+    fps: float = 0.0
+    start_time: float = 0.0    # время первого кадра видео, unix time
+    files: list = field(default_factory=list)
+
+
+def plan_video(path, segment_seconds, start_time=None):
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if frames <= 0:
+        logger.warning("Cannot read %s, skipped", path)
+        return []
+    if start_time is None:
+        # Время записи неизвестно: считаем, что файл дописан в момент mtime
+        start_time = os.path.getmtime(path) - frames / fps
+    segment = max(1, int(segment_seconds * fps))
+    return [Job(f'{path}#{start}-{min(start + segment, frames)}', path, start, min(start + segment, frames),
+                fps, start_time)
+            for start in range(0, frames, segment)]
+
+
+def plan_images(folder, images_per_job):
+    files = sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                   if name.lower().endswith(IMAGE_EXTENSIONS))
+    return [Job(f'{folder}#{start}-{min(start + images_per_job, len(files))}', folder, start,
+                min(start + images_per_job, len(files)), files=files[start:start + images_per_job])
+            for start in range(0, len(files), images_per_job)]
+
+
+def plan_jobs(inputs, segment_seconds, images_per_job, start_time=None):
+    jobs = []
+    for path in inputs:
+        if os.path.isdir(path):
+            jobs += plan_images(path, images_per_job)
+        elif path.lower().endswith(VIDEO_EXTENSIONS):
+            jobs += plan_video(path, segment_seconds, start_time)
+        else:
+            logger.warning("Unsupported input %s, skipped", path)
+    return jobs
+
+
+def read_frames(job, stride):
+    # (номер кадра, время, кадр) с шагом stride
+    if job.files:
+        for offset, path in enumerate(job.files):
+            if offset % stride:
+                continue
+            frame = cv2.imread(path)
+            if frame is not None:
+                yield job.start + offset, os.path.getmtime(path), frame
+        return
+
+    cap = cv2.VideoCapture(job.source)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, job.start)
+    try:
+        for index in range(job.start, job.end):
+            # grab() без декодирования для пропускаемых кадров
+            if (index - job.start) % stride:
+                if not cap.grab():
+                    break
+                continue
+            ret, frame = cap.read()
+            if not ret:
+                break
+            yield index, job.start_time + index / job.fps, frame
+    finally:
+        cap.release()
+
+
+_worker = {}
+
+
+def init_worker(options):
+    # Один раз на процесс: свои модели и ограничение потоков (и у OpenCV, и у бэкенда моделей)
+    cv2.setNumThreads(options['threads'])
+    _worker['options'] = options
+    _worker['procv'] = ProcVideo(models=dict(options['models'], threads=options['threads']), **options['detector'])
+    _worker['thumbnails'] = ThumbnailStore(f"{options['root']}/thumbs")
+
+
+def source_key(path):
+    # Один и тот же файл под разными относительными путями — один источник
+    return os.path.normcase(os.path.abspath(path))
+
+
+def save_frame(frame, job, index, camera_id, timestamp):
+    # Имя из источника и номера кадра; короткий хеш пути различает одноимённые файлы из разных папок.
+    # Кадры прошлого прогона источника к этому моменту уже удалены, см. drop_previous
+    options = _worker['options']
+    folder = day_folder(options['root'], camera_id, timestamp)
+    os.makedirs(folder, exist_ok=True)
+    source = job.files[index - job.start] if job.files else job.source
+    stem = os.path.splitext(os.path.basename(source))[0]
+    digest = hashlib.sha1(source_key(source).encode('utf-8')).hexdigest()[:8]
+    path = f'{folder}/batch_{stem}_{digest}_{index:08d}.jpg'
+    ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, options['jpeg_quality']])
+    if not ok:
+        return None, None
+    with open(path, 'wb') as file:
+        file.write(buffer)
+    return path, _worker['thumbnails'].put(frame, buffer)
+
+
+def process_job(job):
+    options = _worker['options']
+    procv = _worker['procv']
+    camera_id = options['camera_id']
+    tracker = Tracker(**options['tracking'])
+    records = []  # записи для отчёта в порядке START
+    # id(SmokingEvent) -> запись; id однозначен, только пока трекер держит событие, поэтому ключ убирается на END
+    active = {}
+
+    def apply(actions, frame=None, index=None, timestamp=None):
+        for action in actions:
+            key = id(action.event)
+            if action.kind == START:
+                active[key] = {'track_id': action.event.track_id, 'images': []}
+                records.append(active[key])
+            record = active.get(key)
+            if record is None:
+                continue
+            if action.kind == END:
+                del active[key]
+            record.update(start=action.event.start, end=action.event.end,
+                          confidence=float(action.event.confidence))
+            if action.kind in (START, KEYFRAME) and options['save_images']:
+                path, thumb = save_frame(frame, job, index, camera_id, timestamp)
+                if path:
+                    record['images'].append({'path': path, 'ts': timestamp, 'frame': index, 'thumb': thumb,
+                                             'box': np.asarray(action.box).tolist()})
+
+    def run(batch):
+        detections = procv.detect_batch([frame for _, _, frame in batch])
+        for (index, timestamp, frame), detection in zip(batch, detections):
+            apply(tracker.update(detection.people, detection.smokers, timestamp), frame, index, timestamp)
+
+    batch = []
+    for item in read_frames(job, options['stride']):
+        batch.append(item)
+        if len(batch) == options['batch_size']:
+            run(batch)
+            batch = []
+    if batch:
+        run(batch)
+    apply(tracker.flush())
+    return job.job_id, [dict(record, source=job.source) for record in records]
+
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path, 'r', encoding='utf-8') as file:
+        return set(json.load(file)['done'])
+
+
+def save_checkpoint(path, done):
+    if not path:
+        return
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump({'done': sorted(done), 'updated': datetime.now().isoformat()}, file)
+    os.replace(tmp_path, path)
+
+
+class Report:
+    # Одна строка на событие курения, CSV или JSONL по расширению файла
+    fields = ['source', 'camera_id', 'event_id', 'track_id', 'start', 'end', 'confidence', 'images']
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        if path:
+            new = not os.path.exists(path)
+            self.file = open(path, 'a', encoding='utf-8', newline='')
+            self.csv = None
+            if path.lower().endswith('.csv'):
+                self.csv = csv.DictWriter(self.file, self.fields)
+                if new:
+                    self.csv.writeheader()
+
+    def write(self, row):
+        if self.file is None:
+            return
+        if self.csv is not None:
+            self.csv.writerow(dict(row, images=';'.join(row['images'])))
+        else:
+            self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def drop_previous(db_path, sources):
+    # Новый прогон источника заменяет его прежние события: строки и отдельные файлы кадров
+    # (кадры, уже сжатые в архив дня, уберёт retention)
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        for source in sources:
+            with conn:
+                paths = [row[0] for row in conn.execute('''SELECT path FROM фотографии WHERE event_id IN
+                                                            (SELECT id FROM события WHERE source = ?)''', (source,))]
+                conn.execute('''DELETE FROM фотографии WHERE event_id IN
+                                (SELECT id FROM события WHERE source = ?)''', (source,))
+                events = conn.execute('''DELETE FROM события WHERE source = ?''', (source,)).rowcount
+            for path in paths:
+                if parse_locator(path) is None:
+                    remove_file(path)
+            if events:
+                logger.info("%s: %d events from a previous run removed", source, events)
+    finally:
+        conn.close()
+
+
+def store(writer, camera_id, events):
+    # В очередь записи; id событий появятся после writer.flush().
+    # Событие пишется и без кадров (--no-images), тогда path у него пустой
+    stored = []
+    for record in events:
+        images = record['images']
+        event = SmokingEvent(record['track_id'], record['start'], record['end'], record['confidence'])
+        writer.add_event(camera_id, event, images[0]['path'] if images else None, source_key(record['source']))
+        for image in images:
+            writer.add_record(camera_id, image['path'], image['ts'], [image['box']], record['confidence'],
+                              event=event, thumb=image['thumb'])
+        stored.append((record, event))
+    return stored
+
+
+def report_events(report, camera_id, stored):
+    for record, event in stored:
+        images = record['images']
+        report.write({'source': record['source'], 'camera_id': camera_id, 'event_id': event.record_id,
+                      'track_id': record['track_id'], 'start': format_datetime(record['start']),
+                      'end': format_datetime(record['end']), 'confidence': round(record['confidence'], 3),
+                      'images': [image['path'] for image in images]})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Поиск курения в записанных видео и папках с картинками")
+    parser.add_argument('inputs', nargs='+', help="видеофайлы и/или папки с картинками")
+    parser.add_argument('--camera-id', type=int, default=0, help="id_camera для записей в базе")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--threads', type=int, default=2, help="потоков на процесс")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--stride', type=int, default=1, help="обрабатывать каждый N-й кадр")
+    parser.add_argument('--segment-seconds', type=float, default=300, help="длина отрезка видео на процесс")
+    parser.add_argument('--images-per-job', type=int, default=500)
+    parser.add_argument('--start-time', help="время начала записи, ISO, для всех видео")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--root', default='detected')
+    parser.add_argument('--no-images', action='store_true', help="не сохранять кадры событий")
+    parser.add_argument('--report', help="отчёт .csv или .jsonl")
+    parser.add_argument('--checkpoint', help="файл с готовыми отрезками для продолжения прогона")
+    parser.add_argument('--config', default='config.json')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    config = load_config(args.config)
+    start_time = datetime.fromisoformat(args.start_time).timestamp() if args.start_time else None
+    jobs = plan_jobs(args.inputs, args.segment_seconds, args.images_per_job, start_time)
+    done = load_checkpoint(args.checkpoint)
+    jobs = [job for job in jobs if job.job_id not in done]
+    logger.info("%d jobs to process, %d already done", len(jobs), len(done))
+
+    options = {
+        'camera_id': args.camera_id, 'threads': args.threads, 'batch_size': args.batch_size,
+        'stride': max(1, args.stride), 'root': args.root, 'save_images': not args.no_images,
+        'jpeg_quality': config['writer']['jpeg_quality'], 'detector': config['detector'],
+        'models': config['models'], 'tracking': config['tracking'],
+    }
+    writer = PersistenceWriter(args.db, args.root, **config['writer'])
+    # Источники, у которых нет готовых отрезков в контрольной точке, сканируются заново
+    started = {job_id.rpartition('#')[0] for job_id in done}
+    drop_previous(args.db, sorted({source_key(job.source) for job in jobs if job.source not in started}))
+    report = Report(args.report)
+    try:
+        with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(options,)) as pool:
+            futures = {pool.submit(process_job, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    job_id, events = future.result()
+                except Exception:
+                    logger.exception("Job %s failed", job.job_id)
+                    continue
+                stored = store(writer, args.camera_id, events)
+                # Отрезок считается готовым только после коммита его строк
+                writer.flush()
+                report_events(report, args.camera_id, stored)
+                done.add(job_id)
+                save_checkpoint(args.checkpoint, done)
+                logger.info("%s: %d events", job_id, len(events))
+    finally:
+        writer.close()
+        report.close()
+
+
+if __name__ == "__main__":
+    main()
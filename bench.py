@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from alg import ProcVideo
+from backends import PoseResult, BoxResult, load_backend, TORCH, POSE
+from tracker import Tracker
+from writer import PersistenceWriter
+
+
+CAMERA_FPS = 25  # время кадров для трекера: события и ключевые кадры считаются в секундах
+
+# Порядок строк в отчёте
+STAGES = ['decode', 'pose', 'elbow', 'cigarettes', 'recognition', 'paint', 'persist', 'qt', 'frame']
+
+
+class StageTimer:
+    # Задержки по шагам в секундах; ProcVideo.timer вызывает time() внутри detect_batch
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.enabled = True
+
+    @contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.samples[name].append(time.perf_counter() - start)
+
+    def summary(self):
+        stats = {}
+        for name, samples in self.samples.items():
+            ms = np.asarray(samples) * 1000
+            stats[name] = {
+                'count': len(ms),
+                'mean_ms': round(float(ms.mean()), 4),
+                'p50_ms': round(float(np.percentile(ms, 50)), 4),
+                'p95_ms': round(float(np.percentile(ms, 95)), 4),
+                'p99_ms': round(float(np.percentile(ms, 99)), 4),
+            }
+        return stats
+
+
+class StubPoseModel:
+    # Вместо yolov8s-pose: по кругу отдаёт записанные или синтетические позы.
+    # latency — сколько секунд изображать инференс на один кадр
+    def __init__(self, fixtures, latency=0.0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.position = 0
+
+    def predict(self, images, conf, imgsz=None):
+        if self.latency:
+            time.sleep(self.latency * len(images))
+        results = []
+        for _ in images:
+            fixture = self.fixtures[self.position % len(self.fixtures)]
+            self.position += 1
+            results.append(PoseResult(fixture['keypoints'], fixture['boxes'],
+                                      np.ones(len(fixture['boxes']), np.float32)))
+        return results
+
+
+class StubCigaretteModel:
+    # Вместо v8s: в доле hit_rate кропов «находит» сигарету в центре кропа
+    def __init__(self, hit_rate=0.5, latency=0.0, seed=0):
+        self.hit_rate = hit_rate
+        self.latency = latency
+        self.rng = np.random.default_rng(seed)
+
+    def predict(self, images, conf, imgsz=None):
+        if self.latency:
+            time.sleep(self.latency * len(images))
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            if self.rng.random() < self.hit_rate:
+                box = [width / 2 - 10, height / 2 - 4, width / 2 + 10, height / 2 + 4]
+                results.append(BoxResult(np.array([box], np.float32), np.array([0.8], np.float32)))
+            else:
+                results.append(BoxResult(np.zeros((0, 4), np.float32), np.zeros(0, np.float32)))
+        return results
+
+
+def synthetic_pose(rng, width, height, people):
+    # Люди стоят в ряд; у части рука согнута и кисть у лица
+    keypoints = np.zeros((people, 17, 2), np.float32)
+    boxes = np.zeros((people, 4), np.float32)
+    step = width / max(people, 1)
+    for i in range(people):
+        centre = step * (i + 0.5) + rng.uniform(-step / 8, step / 8)
+        scale = height * rng.uniform(0.5, 0.8)
+        top = rng.uniform(0, height - scale)
+        nose_y = top + scale * 0.08
+        shoulder_y = top + scale * 0.2
+        keypoints[i, 0] = centre, nose_y
+        keypoints[i, 5] = centre - scale * 0.1, shoulder_y
+        keypoints[i, 6] = centre + scale * 0.1, shoulder_y
+        for shoulder, elbow, wrist in ((5, 7, 9), (6, 8, 10)):
+            side = -1 if shoulder == 5 else 1
+            elbow_point = (keypoints[i, shoulder, 0] + side * scale * 0.03, shoulder_y + scale * 0.18)
+            keypoints[i, elbow] = elbow_point
+            if rng.random() < 0.4:
+                # согнутая рука: кисть поднята к подбородку
+                keypoints[i, wrist] = centre + side * scale * 0.03, nose_y + scale * 0.06
+            else:
+                keypoints[i, wrist] = elbow_point[0], elbow_point[1] + scale * 0.18
+        boxes[i] = centre - scale * 0.2, top, centre + scale * 0.2, top + scale
+    return {'keypoints': keypoints, 'boxes': boxes}
+
+
+def synthetic_fixtures(count, width, height, people, seed=0):
+    rng = np.random.default_rng(seed)
+    return [synthetic_pose(rng, width, height, people) for _ in range(count)]
+
+
+def load_fixtures(path):
+    # JSON: [{"keypoints": (P, 17, 2), "boxes": (P, 4)}, ...] — см. record_fixtures
+    with open(path, 'r', encoding='utf-8') as file:
+        frames = json.load(file)['frames']
+    return [{'keypoints': np.asarray(frame['keypoints'], np.float32).reshape(-1, 17, 2),
+             'boxes': np.asarray(frame['boxes'], np.float32).reshape(-1, 4)} for frame in frames]
+
+
+def record_fixtures(video, path, limit, backend=TORCH, weights='yolov8s-pose.pt'):
+    # Прогон настоящей модели позы по видео, чтобы дальше мерить без весов
+    model = load_backend(backend, weights, POSE)
+    cap = cv2.VideoCapture(video)
+    frames = []
+    while len(frames) < limit:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        result = model.predict([frame], conf=0.5)[0]
+        frames.append({'keypoints': result.keypoints.round(1).tolist(), 'boxes': result.boxes.round(1).tolist()})
+    cap.release()
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'video': video, 'frames': frames}, file)
+    return len(frames)
+
+
+def synthetic_frames(count, width, height, seed=0):
+    # JPEG, чтобы шаг decode мерил настоящее декодирование
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(count):
+        image = cv2.resize(rng.integers(0, 255, (height // 16, width // 16, 3), dtype=np.uint8), (width, height))
+        frames.append(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1])
+    return frames
+
+
+def frame_source(args):
+    if args.video:
+        cap = cv2.VideoCapture(args.video)
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ret, frame = cap.read()
+                if not ret:
+                    raise SystemExit(f"Cannot read {args.video}")
+            yield frame
+    frames = synthetic_frames(min(args.frames, 50), args.width, args.height, args.seed)
+    position = 0
+    while True:
+        yield cv2.imdecode(frames[position % len(frames)], cv2.IMREAD_COLOR)
+        position += 1
+
+
+def qt_converter():
+    # Тот же путь, что Window.show_frame; без PySide6 шаг пропускается
+    try:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PySide6.QtGui import QGuiApplication, QImage, QPixmap
+    except ImportError:
+        return None
+    app = QGuiApplication.instance() or QGuiApplication(sys.argv[:1])
+
+    def convert(frame):
+        h, w = frame.shape[:2]
+        image = QImage(frame.data, w, h, frame.strides[0], QImage.Format_BGR888)
+        return QPixmap.fromImage(image)
+    convert.app = app
+    return convert
+
+
+def run(args):
+    if args.fixtures:
+        fixtures = load_fixtures(args.fixtures)
+    else:
+        fixtures = synthetic_fixtures(64, args.width, args.height, args.people, args.seed)
+    timer = StageTimer()
+    tracker = Tracker()
+    procv = ProcVideo(pose_model=StubPoseModel(fixtures, args.pose_latency),
+                      cigarette_model=StubCigaretteModel(args.hit_rate, args.cigarette_latency, args.seed))
+    procv.timer = timer
+    convert = qt_converter()
+    source = frame_source(args)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        procv.writer = PersistenceWriter(os.path.join(tmp, 'bench.db'), os.path.join(tmp, 'detected'))
+        started = None
+        epoch = time.time()
+        for index in range(args.warmup + args.frames):
+            if index == args.warmup:
+                timer.samples.clear()
+                started = time.perf_counter()
+            with timer.time('frame'):
+                with timer.time('decode'):
+                    frame = next(source)
+                detection = procv.detect_batch([frame])[0]
+                with timer.time('paint'):
+                    display = procv.paint(frame, detection, (args.display_width, args.display_height))
+                # Как PersistStage: трекер превращает детекции в события, сохраняются только их кадры
+                with timer.time('persist'):
+                    timestamp = epoch + index / CAMERA_FPS
+                    for action in tracker.update(detection.people, detection.smokers, timestamp):
+                        procv.persist_event(frame, action, timestamp=timestamp)
+                if convert is not None:
+                    with timer.time('qt'):
+                        convert(display)
+        elapsed = time.perf_counter() - started
+        # Кодирование JPEG и база идут в фоне; их догоняем вне замеров
+        timer.enabled = False
+        for action in tracker.flush():
+            procv.persist_event(None, action)
+        procv.close()
+
+    return {
+        'meta': {
+            'frames': args.frames, 'width': args.width, 'height': args.height, 'people': args.people,
+            'fixtures': args.fixtures, 'video': args.video, 'python': platform.python_version(),
+            'machine': platform.machine(), 'opencv': cv2.__version__,
+        },
+        'fps': round(args.frames / elapsed, 2),
+        'stages': timer.summary(),
+    }
+
+
+def compare(result, baseline, tolerance, min_delta_ms):
+    # Регрессия — p95 шага выросла больше чем на tolerance (и заметно в миллисекундах) или упал FPS
+    regressions = []
+    for name, stats in result['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if base is None:
+            continue
+        delta = stats['p95_ms'] - base['p95_ms']
+        if delta > min_delta_ms and stats['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']:.3f} -> {stats['p95_ms']:.3f} ms")
+    if baseline.get('fps') and result['fps'] < baseline['fps'] / (1 + tolerance):
+        regressions.append(f"fps: {baseline['fps']} -> {result['fps']}")
+    return regressions
+
+
+def print_report(result, baseline=None):
+    print(f"{'stage':<12}{'count':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'base p95':>10}")
+    for name in STAGES:
+        stats = result['stages'].get(name)
+        if stats is None:
+            continue
+        base = (baseline or {}).get('stages', {}).get(name)
+        base_p95 = f"{base['p95_ms']:10.3f}" if base else f"{'-':>10}"
+        print(f"{name:<12}{stats['count']:>7}{stats['mean_ms']:10.3f}{stats['p50_ms']:10.3f}"
+              f"{stats['p95_ms']:10.3f}{stats['p99_ms']:10.3f}{base_p95}")
+    print(f"FPS: {result['fps']}" + (f" (baseline {baseline['fps']})" if baseline else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замер шагов ProcVideo на заглушках моделей, без весов и камеры")
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--display-width', type=int, default=960)
+    parser.add_argument('--display-height', type=int, default=540)
+    parser.add_argument('--people', type=int, default=3, help="людей на синтетическом кадре")
+    parser.add_argument('--hit-rate', type=float, default=0.5, help="доля кропов с сигаретой")
+    parser.add_argument('--pose-latency', type=float, default=0.0, help="имитация инференса, сек на кадр")
+    parser.add_argument('--cigarette-latency', type=float, default=0.0, help="имитация инференса, сек на кроп")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--video', help="декодировать кадры из видео вместо синтетических")
+    parser.add_argument('--fixtures', help="JSON с записанными позами, см. --record")
+    parser.add_argument('--record', metavar='FIXTURES', help="записать позы из --video настоящей моделью и выйти")
+    parser.add_argument('--output', help="сохранить результат в JSON")
+    parser.add_argument('--baseline', help="сравнить с сохранённым результатом")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="допустимый рост p95, доля")
+    parser.add_argument('--min-delta-ms', type=float, default=0.5, help="меньшие изменения p95 не считаются")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        if not args.video:
+            parser.error("--record needs --video")
+        print(f"Recorded {record_fixtures(args.video, args.record, args.frames)} frames to {args.record}")
+        return 0
+
+    if args.baseline and not os.path.exists(args.baseline):
+        # Иначе опечатка в пути молча отключает проверку регрессий
+        parser.error(f"baseline not found: {args.baseline}")
+
+    result = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(result, file, indent=2)
+
+    if baseline is not None:
+        regressions = compare(result, baseline, args.tolerance, args.min_delta_ms)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class InferenceSettings:
+    # Параметры инференса одного кадра; None — значения модели по умолчанию
+    pose_imgsz: int = None
+    cigarette_imgsz: int = None
+    max_crops: int = None
+
+
+def round_size(size, multiple=32):
+    # YOLO требует размер входа кратный шагу сети
+    return max(multiple, int(round(size / multiple)) * multiple)
+
+
+class BudgetController:
+    # Один на камеру: сглаженная задержка кадра (захват -> результат моделей) сравнивается
+    # с бюджетом, и уровень качества меняется на шаг. Уровень 0 — максимальные размеры входа,
+    # все кропы и каждый кадр; последний — минимальные размеры, мало кропов и большой шаг
+    def __init__(self, target_ms=200, pose_imgsz=(320, 640), cigarette_imgsz=(256, 640), stride=(1, 4),
+                 max_crops=(2, 8), levels=6, hysteresis=0.2, cooldown=10, alpha=0.2):
+        self.target = target_ms / 1000
+        self.pose_imgsz = pose_imgsz              # (минимум, максимум)
+        self.cigarette_imgsz = cigarette_imgsz
+        self.stride = stride
+        self.max_crops = max_crops
+        self.levels = max(1, levels)
+        self.hysteresis = hysteresis              # доля бюджета, внутри которой уровень не меняется
+        self.cooldown = cooldown                  # измерений после смены уровня до следующей
+        self.alpha = alpha                        # вес нового измерения в скользящем среднем
+        self.level = 0
+        self.latency = None
+        self.since_change = 0
+        self.frames = 0
+
+    def quality(self):
+        # 1 — лучшее качество, 0 — худшее
+        return 1.0 if self.levels == 1 else 1 - self.level / (self.levels - 1)
+
+    def interpolate(self, bounds, quality):
+        low, high = bounds
+        return low + (high - low) * quality
+
+    def settings(self):
+        quality = self.quality()
+        return InferenceSettings(round_size(self.interpolate(self.pose_imgsz, quality)),
+                                 round_size(self.interpolate(self.cigarette_imgsz, quality)),
+                                 int(round(self.interpolate(self.max_crops, quality))))
+
+    def current_stride(self):
+        return int(round(self.interpolate(self.stride, 1 - self.quality())))
+
+    def should_run(self):
+        # Вызывается на каждый кадр камеры; False — взять прошлый результат
+        run = self.frames % self.current_stride() == 0
+        self.frames += 1
+        return run
+
+    def update(self, latency):
+        self.latency = latency if self.latency is None else (1 - self.alpha) * self.latency + self.alpha * latency
+        self.since_change += 1
+        if self.since_change < self.cooldown:
+            return
+        if self.latency > self.target * (1 + self.hysteresis) and self.level < self.levels - 1:
+            self.level += 1
+        elif self.latency < self.target * (1 - self.hysteresis) and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        self.since_change = 0
+        self.frames = 0
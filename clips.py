@@ -0,0 +1,168 @@
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from tracker import START
+
+
+logger = logging.getLogger(__name__)
+
+
+class FrameRing:
+    # Последние seconds секунд кадров камеры, уже сжатых в JPEG, с ограничением по байтам
+    def __init__(self, seconds=5.0, max_bytes=64 * 1024 * 1024):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.frames = deque()  # (timestamp, JPEG)
+        self.size = 0
+
+    def push(self, timestamp, data):
+        self.frames.append((timestamp, data))
+        self.size += len(data)
+        while self.frames and (self.frames[0][0] < timestamp - self.seconds or self.size > self.max_bytes):
+            _, old = self.frames.popleft()
+            self.size -= len(old)
+
+    def since(self, start):
+        return [(timestamp, data) for timestamp, data in self.frames if timestamp >= start]
+
+
+@dataclass
+class Clip:
+    camera_id: int
+    event: object       # tracker.SmokingEvent, вызвавшее запись
+    start: float
+    deadline: float     # запись идёт до этого времени
+    frames: list = field(default_factory=list)
+
+
+class ClipRecorder:
+    # Ролик на каждый эпизод курения: pre_seconds до START из кольцевого буфера и post_seconds
+    # после последнего кадра с курением. Кадры хранятся в JPEG уменьшенными до width и не чаще fps,
+    # файл собирает cv2.VideoWriter в фоне, строка пишется в таблицу клипы
+    def __init__(self, writer, pre_seconds=5.0, post_seconds=5.0, max_seconds=60.0, fps=10,
+                 width=960, quality=80, fourcc='mp4v', extension='mp4', ring_bytes=64 * 1024 * 1024):
+        self.writer = writer
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_seconds = max_seconds
+        self.fps = fps
+        self.width = width
+        self.quality = quality
+        self.fourcc = fourcc
+        self.extension = extension
+        self.ring_bytes = ring_bytes
+        self.rings = {}
+        self.last_frame = {}
+        self.active = {}  # id камеры -> Clip
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='clip')
+
+    def encode(self, frame):
+        height, width = frame.shape[:2]
+        if width > self.width:
+            frame = cv2.resize(frame, (self.width, round(height * self.width / width)), interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return buffer.tobytes() if ok else None
+
+    def add_frame(self, camera_id, frame, timestamp, event_active=False):
+        # event_active — на кадре курят в рамках события: запись продлевается на каждом таком кадре,
+        # а не только по действиям трекера (ключевых кадров на событие немного)
+        if event_active:
+            self.extend(camera_id, timestamp)
+        # Кадры чаще fps в ролик не попадают и не кодируются
+        last = self.last_frame.get(camera_id)
+        if last is not None and timestamp - last < 1 / self.fps:
+            return
+        data = self.encode(frame)
+        if data is None:
+            return
+        self.last_frame[camera_id] = timestamp
+        if camera_id not in self.rings:
+            self.rings[camera_id] = FrameRing(self.pre_seconds, self.ring_bytes)
+        self.rings[camera_id].push(timestamp, data)
+        clip = self.active.get(camera_id)
+        if clip is not None and timestamp >= clip.start:
+            clip.frames.append((timestamp, data))
+
+    def trigger(self, camera_id, action, timestamp):
+        clip = self.active.get(camera_id)
+        if clip is None:
+            if action.kind != START:
+                return
+            start = timestamp - self.pre_seconds
+            ring = self.rings.get(camera_id)
+            self.active[camera_id] = Clip(camera_id, action.event, start, timestamp, ring.since(start) if ring else [])
+        # Любое действие события на камере (и новое событие) продлевает запись
+        self.extend(camera_id, timestamp)
+
+    def extend(self, camera_id, timestamp):
+        clip = self.active.get(camera_id)
+        if clip is not None:
+            clip.deadline = min(max(clip.deadline, timestamp + self.post_seconds), clip.start + self.max_seconds)
+
+    def check(self, now):
+        # Ролик закрывается по времени кадров камеры; если камера замолчала — по часам с запасом
+        for camera_id, clip in list(self.active.items()):
+            if self.last_frame.get(camera_id, 0) > clip.deadline or now > clip.deadline + self.post_seconds:
+                self.finish(camera_id)
+
+    def finish(self, camera_id):
+        clip = self.active.pop(camera_id)
+        if clip.frames:
+            self.executor.submit(self.write, clip)
+
+    def path_for(self, clip):
+        # Рядом с кадрами камеры за тот же день: detected/cam_N/YYYY-MM-DD/clips
+        folder = f'{self.writer.folder(clip.camera_id, clip.start)}/clips'
+        os.makedirs(folder, exist_ok=True)
+        name = datetime.fromtimestamp(clip.start).strftime('%Y-%m-%d_%H-%M-%S')
+        return f'{folder}/{name}_{clip.event.track_id}.{self.extension}'
+
+    def write(self, clip):
+        path = self.path_for(clip)
+        video = None
+        size = None
+        # Кадры приходят с частотой отрисовки (на CPU — частотой распознавания), а не fps. Чтобы ролик шёл
+        # в реальном времени, каждый кадр повторяется до слота 1/fps, в который попадает следующий
+        first = clip.frames[0][0]
+        slots = [round((timestamp - first) * self.fps) for timestamp, _ in clip.frames]
+        written = 0
+        try:
+            for index, (_, data) in enumerate(clip.frames):
+                frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if frame is None:
+                    continue
+                if video is None:
+                    size = (frame.shape[1], frame.shape[0])
+                    video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, size)
+                    if not video.isOpened():
+                        logger.error("Cannot open video writer for %s", path)
+                        return
+                if (frame.shape[1], frame.shape[0]) != size:
+                    frame = cv2.resize(frame, size)
+                until = slots[index + 1] if index + 1 < len(slots) else written + 1
+                while written < until:
+                    video.write(frame)
+                    written += 1
+        except Exception:
+            logger.exception("Failed to write clip %s", path)
+            return
+        finally:
+            if video is not None:
+                video.release()
+        if video is None:
+            return
+        # id события подставит поток записи, см. PersistenceWriter.add_event
+        self.writer.add_clip(clip.camera_id, path, clip.frames[0][0], clip.frames[-1][0], clip.event, written,
+                             os.path.getsize(path))
+
+    def close(self):
+        for camera_id in list(self.active):
+            self.finish(camera_id)
+        self.executor.shutdown(wait=True)
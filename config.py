@@ -0,0 +1,145 @@
+import copy
+import json
+import os
+
+
+CONFIG_PATH = 'config.json'
+
+# Значения по умолчанию; config.json переопределяет только указанные ключи
+DEFAULTS = {
+    # id — номер камеры в базе и в папке detected/cam_N,
+    # source — индекс устройства или URL потока, api — бэкенд cv2.VideoCapture
+    'cameras': [
+        {'id': 0, 'source': 0, 'api': 'dshow', 'width': 1920, 'height': 1080},
+    ],
+    # Модели и бэкенд инференса: 'torch' (.pt), 'onnx' (.onnx) или 'openvino' (.xml),
+    # файлы для onnx/openvino готовит python backends.py; threads 0 — по числу ядер
+    'models': {
+        'backend': 'torch',
+        'pose': 'yolov8s-pose.pt',
+        'cigarette': 'v8s.pt',
+        'threads': 0,
+        'imgsz': 640,
+    },
+    # Инференс в отдельных процессах, см. workers.WorkerPool; 0 — в процессе окна.
+    # threads — потоков OpenCV и бэкенда модели в каждом процессе
+    'workers': {
+        'processes': 0,
+        'threads': 2,
+    },
+    # Параметры распознавания, см. alg.ProcVideo
+    'detector': {
+        'association': 'centre',
+        'association_threshold': 0.25,
+        'cigarette_roi': True,
+    },
+    'pipeline': {
+        'queue_size': 1,
+        'drop_policy': 'drop_oldest',
+        'persist_queue_size': 64,
+        'persist_policy': 'block',
+    },
+    # Пропуск инференса на статичной сцене, см. motion.MotionGate
+    'motion': {
+        'enabled': True,
+        'threshold': 0.005,
+        'pixel_threshold': 25,
+        'scale_width': 160,
+        'cooldown': 15,
+        'idle_stride': 0,
+        'refresh_every': 30,
+    },
+    # Подстройка качества под бюджет задержки кадра, см. budget.BudgetController;
+    # пары — (минимум, максимум), у камеры можно задать свой 'budget_ms'
+    'budget': {
+        'enabled': True,
+        'target_ms': 200,
+        'pose_imgsz': [320, 640],
+        'cigarette_imgsz': [256, 640],
+        'stride': [1, 4],
+        'max_crops': [2, 8],
+        'levels': 6,
+        'hysteresis': 0.2,
+        'cooldown': 10,
+    },
+    # Трекинг людей и события курения, см. tracker.Tracker
+    'tracking': {
+        'iou_threshold': 0.3,
+        'max_distance': 0.5,
+        'max_missed': 15,
+        'window': 10,
+        'confirm_hits': 5,
+        'keyframes': 3,
+        'keyframe_interval': 5.0,
+        'end_after': 60.0,
+    },
+    # Фоновая запись кадров и строк базы, см. writer.PersistenceWriter
+    'writer': {
+        'batch_size': 100,
+        'batch_interval': 1.0,
+        'encode_workers': 2,
+        'jpeg_quality': 95,
+    },
+    # Ролик на эпизод курения из кольцевого буфера кадров камеры, см. clips.ClipRecorder
+    'clips': {
+        'enabled': True,
+        'pre_seconds': 5.0,
+        'post_seconds': 5.0,
+        'max_seconds': 60.0,
+        'fps': 10,
+        'width': 960,
+        'quality': 80,  # JPEG кадров в буфере
+        'fourcc': 'mp4v',
+        'extension': 'mp4',
+        'ring_bytes': 64 * 1024 * 1024,  # на камеру
+    },
+    # Обслуживание detected/, см. storage.StorageMaintenance: раз в interval секунд кадры дней старше
+    # compact_after_days складываются в архив дня, всё старше max_age_days дней и самые старые дни сверх
+    # max_bytes на камеру удаляются вместе со строками базы; 0 — без ограничения.
+    # У камеры можно задать свои 'retention_days' и 'retention_bytes'
+    'retention': {
+        'enabled': True,
+        'interval': 3600,
+        'compact_after_days': 2,
+        'max_age_days': 0,
+        'max_bytes': 0,
+    },
+    # Миниатюры для галереи, см. thumbnails.ThumbnailStore
+    'thumbnails': {
+        'root': 'detected/thumbs',
+        'width': 480,
+        'quality': 85,
+    },
+    # Метрики в формате Prometheus на http://host:port/metrics, см. metrics.py
+    'metrics': {
+        'enabled': True,
+        'host': '127.0.0.1',
+        'port': 9108,
+        'overlay': False,  # FPS и задержки поверх видео
+    },
+    'logging': {
+        'level': 'INFO',
+    },
+    'gallery': {
+        'cache_bytes': 64 * 1024 * 1024,  # декодированные миниатюры в памяти
+        'image_cache_bytes': 256 * 1024 * 1024,  # полные кадры для просмотра
+        'prefetch': 2,  # соседних кадров с каждой стороны
+    },
+}
+
+
+def merge(base, override):
+    result = copy.deepcopy(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = merge(result[key], value)
+        else:
+            result[key] = copy.deepcopy(value)
+    return result
+
+
+def load_config(path=CONFIG_PATH):
+    if not os.path.exists(path):
+        return copy.deepcopy(DEFAULTS)
+    with open(path, 'r', encoding='utf-8') as file:
+        return merge(DEFAULTS, json.load(file))
@@ -1,22 +1,135 @@
 import sqlite3
+from datetime import date, timedelta
 
-# Создаем соединение с базой данных (если базы данных не существует, она будет автоматически создана)
-conn = sqlite3.connect('smoking_pics.db')
+DB_PATH = 'smoking_pics.db'
 
-# Создаем курсор для выполнения операций с базой данных
-cursor = conn.cursor()
 
-# Создаем таблицу
-cursor.execute('''CREATE TABLE IF NOT EXISTS фотографии (
-                    id_camera INTEGER,
-                    date DATE,
-                    time TIME,
-                    path TEXT
-                )''')
+def migrate_1(cursor):
+    # Исходная схема: кадр с отдельными датой и временем, без ключа и индексов
+    cursor.execute('''CREATE TABLE IF NOT EXISTS фотографии (
+                        id_camera INTEGER,
+                        date DATE,
+                        time TIME,
+                        path TEXT
+                    )''')
 
+    # Одна запись на эпизод курения, кадры эпизода лежат в таблице фотографии
+    cursor.execute('''CREATE TABLE IF NOT EXISTS события (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        id_camera INTEGER,
+                        track_id INTEGER,
+                        start DATETIME,
+                        end DATETIME,
+                        confidence REAL,
+                        path TEXT
+                    )''')
 
-# Сохраняем изменения
-conn.commit()
 
-# Закрываем соединение с базой данных
-conn.close()
+def migrate_2(cursor):
+    # Целочисленный ключ, одна колонка времени 'YYYY-MM-DD HH:MM:SS[.ffffff]',
+    # боксы (JSON список xyxy) и уверенность, индексы под выборку по периоду
+    cursor.execute('''ALTER TABLE фотографии RENAME TO фотографии_v1''')
+    cursor.execute('''CREATE TABLE фотографии (
+                        id INTEGER PRIMARY KEY,
+                        id_camera INTEGER NOT NULL,
+                        ts TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        boxes TEXT,
+                        confidence REAL,
+                        event_id INTEGER
+                    )''')
+    cursor.execute('''INSERT INTO фотографии (id_camera, ts, path)
+                      SELECT COALESCE(id_camera, 0), date || ' ' || time, REPLACE(path, '\\', '/')
+                      FROM фотографии_v1 ORDER BY date, time''')
+    cursor.execute('''DROP TABLE фотографии_v1''')
+    cursor.execute('''CREATE INDEX фотографии_camera_ts ON фотографии (id_camera, ts, id)''')
+    cursor.execute('''CREATE INDEX фотографии_ts ON фотографии (ts, id)''')
+    cursor.execute('''CREATE INDEX события_camera_start ON события (id_camera, start)''')
+
+
+def migrate_3(cursor):
+    # Ключ миниатюры в detected/thumbs (sha1 исходного JPEG)
+    cursor.execute('''ALTER TABLE фотографии ADD COLUMN thumb TEXT''')
+
+
+def migrate_4(cursor):
+    # Ролики эпизодов (clips.ClipRecorder): файл и интервал времени, event_id — запись в события
+    cursor.execute('''CREATE TABLE клипы (
+                        id INTEGER PRIMARY KEY,
+                        id_camera INTEGER NOT NULL,
+                        event_id INTEGER,
+                        start TEXT NOT NULL,
+                        end TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        frames INTEGER,
+                        bytes INTEGER
+                    )''')
+    cursor.execute('''CREATE INDEX клипы_camera_start ON клипы (id_camera, start)''')
+    cursor.execute('''CREATE INDEX клипы_event ON клипы (event_id)''')
+
+
+def migrate_5(cursor):
+    # Источник события для batch.py (абсолютный путь видео или папки): повторный прогон заменяет его события
+    cursor.execute('''ALTER TABLE события ADD COLUMN source TEXT''')
+    cursor.execute('''CREATE INDEX события_source ON события (source)''')
+
+
+# Номер версии схемы хранится в PRAGMA user_version
+MIGRATIONS = [migrate_1, migrate_2, migrate_3, migrate_4, migrate_5]
+
+
+def migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN')
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def create_tables(conn):
+    migrate(conn)
+
+
+def next_day(end_date):
+    # Конец периода 'YYYY-MM-DD' включительно -> исключающая граница по ts
+    return (date.fromisoformat(end_date) + timedelta(days=1)).isoformat()
+
+
+def query_period(conn, start_date=None, end_date=None, camera_id=None, after=None, limit=100):
+    # Страница кадров за период по возрастанию (ts, id); None — граница не задана.
+    # after — (ts, id) последней строки предыдущей страницы
+    sql = '''SELECT id, id_camera, ts, path, boxes, confidence, thumb FROM фотографии WHERE 1'''
+    params = []
+    if start_date is not None:
+        sql += ' AND ts >= ?'
+        params.append(start_date)
+    if end_date is not None:
+        sql += ' AND ts < ?'
+        params.append(next_day(end_date))
+    if camera_id is not None:
+        sql += ' AND id_camera = ?'
+        params.append(camera_id)
+    if after is not None:
+        sql += ' AND (ts > ? OR (ts = ? AND id > ?))'
+        params += [after[0], after[0], after[1]]
+    sql += ' ORDER BY ts, id LIMIT ?'
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
+
+
+def init_db(path=DB_PATH):
+    # Создаем соединение с базой данных (если базы данных не существует, она будет автоматически создана)
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    # Закрываем соединение с базой данных
+    conn.close()
+
+
+if __name__ == "__main__":
+    init_db()
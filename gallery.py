@@ -0,0 +1,189 @@
+import sqlite3
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex, QObject, QRunnable, QSize, QThreadPool, Signal
+from PySide6.QtGui import QColor, QImage, QPixmap
+
+from db import DB_PATH, query_period
+
+
+class LoaderSignals(QObject):
+    page = Signal(int, list)                # generation, rows
+    thumbnail = Signal(int, int, QImage, str)  # generation, row id, image, ключ миниатюры
+
+
+class PageLoader(QRunnable):
+    # Следующая страница строк из базы, в фоне
+    def __init__(self, signals, generation, db_path, query):
+        super().__init__()
+        self.signals = signals
+        self.generation = generation
+        self.db_path = db_path
+        self.query = query
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = query_period(conn, **self.query)
+        except sqlite3.Error:
+            rows = []
+        finally:
+            conn.close()
+        self.signals.page.emit(self.generation, rows)
+
+
+class ThumbnailLoader(QRunnable):
+    # Миниатюра одной строки: при необходимости создаётся и декодируется в фоне
+    def __init__(self, signals, generation, row_id, path, thumb, thumbnails, db_path):
+        super().__init__()
+        self.signals = signals
+        self.generation = generation
+        self.row_id = row_id
+        self.path = path
+        self.thumb = thumb
+        self.thumbnails = thumbnails
+        self.db_path = db_path
+
+    def run(self):
+        thumb_path, key = self.thumbnails.ensure(self.path, self.thumb)
+        if key and key != self.thumb:
+            self.store_key(key)
+        image = QImage(thumb_path) if thumb_path else QImage()
+        self.signals.thumbnail.emit(self.generation, self.row_id, image, key or '')
+
+    def store_key(self, key):
+        # Старые строки без thumb: ключ считается по исходному кадру один раз и запоминается в базе
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        try:
+            with conn:
+                conn.execute('UPDATE фотографии SET thumb = ? WHERE id = ?', (key, self.row_id))
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+
+
+class DetectionListModel(QAbstractListModel):
+    # Кадры из базы, подгружаемые страницами по мере прокрутки (canFetchMore/fetchMore).
+    # Миниатюры декодируются в QThreadPool и хранятся только в ограниченном PixmapCache
+    PathRole = Qt.UserRole + 1
+
+    def __init__(self, thumbnails, cache, db_path=DB_PATH, page_size=100, icon_size=QSize(320, 180),
+                 parent=None):
+        super().__init__(parent)
+        self.thumbnails = thumbnails
+        self.cache = cache
+        self.db_path = db_path
+        self.page_size = page_size
+        self.rows = []
+        self.positions = {}  # row id -> номер строки в модели
+        self.query = None
+        self.after = None
+        self.exhausted = True
+        self.fetching = False
+        self.generation = 0  # меняется при смене фильтра, старые ответы загрузчиков игнорируются
+        self.pending = set()
+        self.missing = set()  # row id без файла кадра: не запрашиваем миниатюру снова
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+        self.signals = LoaderSignals()
+        self.signals.page.connect(self.on_page)
+        self.signals.thumbnail.connect(self.on_thumbnail)
+        self.placeholder = QPixmap(icon_size)
+        self.placeholder.fill(QColor(40, 40, 40))
+        self.missing_placeholder = QPixmap(icon_size)
+        self.missing_placeholder.fill(QColor(90, 30, 30))
+
+    def set_filter(self, camera_id=None, start_date=None, end_date=None):
+        self.beginResetModel()
+        self.generation += 1
+        self.pool.clear()
+        self.rows = []
+        self.positions = {}
+        self.pending.clear()
+        self.missing.clear()
+        self.query = {'start_date': start_date, 'end_date': end_date, 'camera_id': camera_id}
+        self.after = None
+        self.exhausted = False
+        self.fetching = False
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted and not self.fetching
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        self.fetching = True
+        query = dict(self.query, after=self.after, limit=self.page_size)
+        self.pool.start(PageLoader(self.signals, self.generation, self.db_path, query))
+
+    def on_page(self, generation, rows):
+        if generation != self.generation:
+            return
+        self.fetching = False
+        self.exhausted = len(rows) < self.page_size
+        if not rows:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        for position, row in enumerate(rows, first):
+            self.positions[row[0]] = position
+        self.rows.extend(rows)
+        self.after = (rows[-1][2], rows[-1][0])
+        self.endInsertRows()
+
+    def request_thumbnail(self, row):
+        row_id = row[0]
+        if row_id in self.pending:
+            return
+        self.pending.add(row_id)
+        self.pool.start(ThumbnailLoader(self.signals, self.generation, row_id, self.path(row), row[6],
+                                        self.thumbnails, self.db_path))
+
+    def on_thumbnail(self, generation, row_id, image, key):
+        if generation != self.generation:
+            return
+        self.pending.discard(row_id)
+        position = self.positions.get(row_id)
+        if key and position is not None and self.rows[position][6] != key:
+            # После вытеснения из кэша миниатюра найдётся по ключу, без чтения исходного кадра
+            row = self.rows[position]
+            self.rows[position] = row[:6] + (key,) + row[7:]
+        if image.isNull():
+            # Кадра нет: пустую картинку кэш не хранит, поэтому без missing и с dataChanged
+            # data() запрашивал бы миниатюру по кругу. Заглушка появится при следующей отрисовке
+            self.missing.add(row_id)
+            return
+        self.cache.put(row_id, QPixmap.fromImage(image))
+        if position is not None:
+            index = self.index(position)
+            self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def path(self, row):
+        return row[3].replace('\\', '/')
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        row = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            return row[2][:19]
+        if role == Qt.DecorationRole:
+            # Картинку запрашивает только видимый элемент, поэтому и грузятся только они
+            if row[0] in self.missing:
+                return self.missing_placeholder
+            pixmap = self.cache.get(row[0])
+            if pixmap is None:
+                self.request_thumbnail(row)
+                return self.placeholder
+            return pixmap
+        if role == self.PathRole:
+            return self.path(row)
+        return None
+
+    def image_paths(self):
+        return [self.path(row) for row in self.rows]
@@ -1,9 +1,13 @@
+import logging
 import sys
 from PySide6.QtWidgets import QApplication
 from app import Window
+from config import load_config
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=load_config()['logging']['level'],
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     app = QApplication(sys.argv)
     window = Window()
     window.showMaximized()
@@ -0,0 +1,226 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+
+class Metric:
+    # Значения по наборам меток; запись — одна операция под коротким локом
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.functions = {}
+        self.lock = threading.Lock()
+
+    def set_function(self, function, *labels):
+        # Значение читается только при выгрузке, например размер очереди
+        self.functions[labels] = function
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, function in list(self.functions.items()):
+            values[labels] = function()
+        return [(self.name, format_labels(self.labels, labels), value)
+                for labels, value in sorted(values.items(), key=lambda item: item[0])]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{labels} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        function = self.functions.get(labels)
+        return function() if function is not None else self.values.get(labels, 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def get(self, *labels):
+        function = self.functions.get(labels)
+        return function() if function is not None else self.values.get(labels, 0)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0, 0.0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+            state[3] = value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def last(self, *labels):
+        # Последнее значение — для подписи на экране
+        with self.lock:
+            state = self.values.get(labels)
+            return state[3] if state else None
+
+    def samples(self):
+        with self.lock:
+            values = {labels: (list(state[0]), state[1], state[2]) for labels, state in self.values.items()}
+        samples = []
+        for labels, (counts, total, count) in sorted(values.items(), key=lambda item: item[0]):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                samples.append((f'{self.name}_bucket', format_labels(self.labels + ('le',), labels + (le,)),
+                                cumulative))
+            samples.append((f'{self.name}_sum', format_labels(self.labels, labels), total))
+            samples.append((f'{self.name}_count', format_labels(self.labels, labels), count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        # Повторная регистрация возвращает уже существующую метрику
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        # Текстовый формат Prometheus
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Метрики приложения; метка camera — id камеры из config.json
+FRAMES_CAPTURED = REGISTRY.counter('smoking_frames_captured_total', 'Frames read from the camera', ['camera'])
+CAPTURE_FAILURES = REGISTRY.counter('smoking_capture_failures_total', 'Failed camera reads', ['camera'])
+FRAMES_DROPPED = REGISTRY.counter('smoking_frames_dropped_total', 'Frames dropped by a full queue', ['queue'])
+QUEUE_DEPTH = REGISTRY.gauge('smoking_queue_depth', 'Items waiting in a pipeline queue', ['queue'])
+FRAMES_INFERRED = REGISTRY.counter('smoking_frames_inferred_total', 'Frames passed through the models', ['camera'])
+FRAMES_REUSED = REGISTRY.counter('smoking_frames_reused_total', 'Frames that reused the previous detection',
+                                 ['camera'])
+STAGE_SECONDS = REGISTRY.histogram('smoking_stage_seconds', 'Time spent in a detect_batch step', ['stage'])
+INFERENCE_SECONDS = REGISTRY.histogram('smoking_inference_seconds', 'Time of one detect_batch call')
+FRAME_LATENCY = REGISTRY.histogram('smoking_frame_latency_seconds', 'Capture to render latency', ['camera'])
+BUDGET_LEVEL = REGISTRY.gauge('smoking_budget_level', 'Quality level chosen by the latency controller, 0 is best',
+                              ['camera'])
+BUDGET_LATENCY = REGISTRY.gauge('smoking_budget_latency_seconds', 'Smoothed capture to detection latency',
+                                ['camera'])
+DETECTIONS = REGISTRY.counter('smoking_detections_total', 'Smoking regions found on frames', ['camera'])
+EVENTS = REGISTRY.counter('smoking_events_total', 'Tracker actions', ['camera', 'kind'])
+IMAGES_SAVED = REGISTRY.counter('smoking_images_saved_total', 'JPEG files written', ['camera'])
+ENCODE_SECONDS = REGISTRY.histogram('smoking_image_encode_seconds', 'JPEG encoding and file write time')
+DB_ROWS = REGISTRY.counter('smoking_db_statements_total', 'Statements committed to the database')
+DB_ERRORS = REGISTRY.counter('smoking_db_errors_total', 'Failed database batches')
+DB_WRITE_LAG = REGISTRY.histogram('smoking_db_write_lag_seconds', 'Time from enqueue to commit of a statement')
+DB_QUEUE_DEPTH = REGISTRY.gauge('smoking_db_queue_depth', 'Statements waiting for the database writer')
+WORKER_RESTARTS = REGISTRY.counter('smoking_worker_restarts_total', 'Inference worker processes restarted')
+WORKERS_BUSY = REGISTRY.gauge('smoking_workers_busy', 'Inference workers processing a batch')
+STORAGE_BYTES = REGISTRY.gauge('smoking_storage_bytes', 'Bytes used by frames, archives and clips', ['camera'])
+IMAGES_PACKED = REGISTRY.counter('smoking_images_packed_total', 'Frames moved into day archives', ['camera'])
+IMAGES_EXPIRED = REGISTRY.counter('smoking_images_expired_total', 'Frames removed by retention', ['camera'])
+
+
+class StageMetrics:
+    # ProcVideo.timer, который пишет шаги detect_batch в STAGE_SECONDS
+    def time(self, name):
+        return STAGE_SECONDS.time(name)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Опрос раз в несколько секунд не должен засорять лог
+        pass
+
+
+class MetricsServer:
+    # GET http://host:port/metrics в фоновом потоке
+    def __init__(self, host='127.0.0.1', port=9108, registry=REGISTRY):
+        handler = type('Handler', (MetricsHandler,), {'registry': registry})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
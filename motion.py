@@ -0,0 +1,54 @@
+import cv2
+import numpy as np
+
+
+RUN = 'run'      # прогнать кадр через модели
+REUSE = 'reuse'  # сцена не изменилась, взять прошлый результат
+
+
+class MotionGate:
+    # Дешёвый фильтр перед моделями: уменьшенный серый кадр сравнивается
+    # с фоном (скользящее среднее), модели запускаются только при движении
+    def __init__(self, threshold=0.005, pixel_threshold=25, scale_width=160, alpha=0.05,
+                 cooldown=15, idle_stride=0, refresh_every=30):
+        self.threshold = threshold              # доля изменившихся пикселей
+        self.pixel_threshold = pixel_threshold  # разница яркости, 0..255
+        self.scale_width = scale_width
+        self.alpha = alpha                      # скорость обновления фона
+        self.cooldown = cooldown                # столько кадров после движения модели работают всегда
+        self.idle_stride = idle_stride          # на статичной сцене запускать каждый N-й кадр, 0 — никогда
+        self.refresh_every = refresh_every      # принудительный запуск раз в K кадров
+        self.background = None
+        self.since_motion = cooldown
+        self.since_run = 0
+
+    def small_gray(self, frame):
+        height, width = frame.shape[:2]
+        scale = self.scale_width / width
+        small = cv2.resize(frame, (self.scale_width, max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0).astype(np.float32)
+
+    def motion_ratio(self, gray):
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray
+            return 1.0
+        diff = cv2.absdiff(gray, self.background)
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+        return float(np.count_nonzero(diff > self.pixel_threshold)) / diff.size
+
+    def decide(self, frame):
+        if self.motion_ratio(self.small_gray(frame)) >= self.threshold:
+            self.since_motion = 0
+        else:
+            self.since_motion += 1
+        self.since_run += 1
+
+        if (self.since_motion < self.cooldown
+                or self.since_run >= self.refresh_every
+                or (self.idle_stride and self.since_run >= self.idle_stride)):
+            self.since_run = 0
+            return RUN
+        return REUSE
@@ -0,0 +1,530 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import wait
+from dataclasses import dataclass
+
+import cv2
+
+from budget import BudgetController, InferenceSettings
+from clips import ClipRecorder
+from metrics import (FRAMES_CAPTURED, CAPTURE_FAILURES, FRAMES_DROPPED, QUEUE_DEPTH, FRAMES_INFERRED,
+                     FRAMES_REUSED, INFERENCE_SECONDS, FRAME_LATENCY, DETECTIONS, EVENTS, BUDGET_LEVEL,
+                     BUDGET_LATENCY)
+from motion import MotionGate, REUSE
+from tracker import Tracker
+
+
+logger = logging.getLogger(__name__)
+
+
+DROP_OLDEST = 'drop_oldest'  # вытеснить самый старый элемент
+DROP_NEWEST = 'drop_newest'  # отбросить пришедший элемент
+BLOCK = 'block'              # ждать, пока освободится место
+
+
+@dataclass
+class Packet:
+    # Кадр, проходящий по стадиям конвейера
+    frame: object
+    timestamp: float
+    seq: int
+    camera_id: int = 0
+    reused: bool = False  # детекция взята с прошлого кадра, модели не запускались
+    actions: list = None  # события трекера для сохранения
+    event_active: bool = False  # на кадре курит человек с открытым событием, см. ClipStage
+    detection: object = None
+    evidence: object = None
+    display: object = None
+
+
+class FrameQueue:
+    # Ограниченная очередь между стадиями с политикой переполнения
+    def __init__(self, maxsize=1, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError(f"Unknown drop policy: {policy}")
+        self.queue = queue.Queue(maxsize)
+        self.policy = policy
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def put(self, item, timeout=None):
+        if self.policy == BLOCK:
+            try:
+                self.queue.put(item, timeout=timeout)
+                return True
+            except queue.Full:
+                self.dropped += 1
+                return False
+
+        with self._lock:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                pass
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(item)
+            return True
+
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def qsize(self):
+        return self.queue.qsize()
+
+
+class Stage(threading.Thread):
+    # Поток стадии: крутит step(), пока не остановлен
+    poll_interval = 0.1
+
+    def __init__(self, name):
+        super().__init__(name=name, daemon=True)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        try:
+            self.setup()
+            while not self.stop_event.is_set():
+                self.step()
+        finally:
+            self.teardown()
+
+    def setup(self):
+        pass
+
+    def step(self):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+    def stop(self):
+        self.stop_event.set()
+
+
+class CaptureStage(Stage):
+    # Читает камеру без остановки, в выходной очереди всегда лежит последний кадр
+    def __init__(self, output, camera_id=0, source=0, api=cv2.CAP_ANY, width=1920, height=1080,
+                 retry_delay=0.05, reopen_after=50):
+        super().__init__(f'capture-{camera_id}')
+        self.output = output
+        self.camera_id = camera_id
+        self.source = source
+        self.api = api
+        self.width = width
+        self.height = height
+        self.retry_delay = retry_delay
+        self.reopen_after = reopen_after
+        self.cap = None
+        self.failures = 0
+        self.seq = 0
+
+    def open(self):
+        self.cap = cv2.VideoCapture(self.source, self.api)
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        # Не копим кадры в буфере драйвера
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def setup(self):
+        self.open()
+
+    def step(self):
+        ret, kadr = self.cap.read()
+        if not ret:
+            # Камера отвалилась или ещё не готова: ждём, а не крутимся вхолостую
+            self.failures += 1
+            CAPTURE_FAILURES.inc(self.camera_id)
+            if self.failures >= self.reopen_after:
+                self.cap.release()
+                self.open()
+                self.failures = 0
+            self.stop_event.wait(self.retry_delay)
+            return
+        self.failures = 0
+        self.seq += 1
+        FRAMES_CAPTURED.inc(self.camera_id)
+        self.output.put(Packet(kadr, time.time(), self.seq, self.camera_id))
+
+    def teardown(self):
+        if self.cap is not None:
+            self.cap.release()
+
+
+class InferenceStage(Stage):
+    # Собирает последние кадры со всех камер и прогоняет их через модели одним батчем
+    idle_wait = 0.005
+
+    def __init__(self, procv, inputs, output, motion=None, budgets=None, pool=None):
+        super().__init__('inference')
+        self.procv = procv
+        self.inputs = inputs
+        self.output = output
+        # workers.WorkerPool — модели в отдельных процессах, несколько пачек в работе одновременно;
+        # None — detect_batch прямо в этом потоке
+        self.pool = pool
+        self.pending = deque()  # (пакеты, свежие пакеты, future, время отправки) в порядке захвата
+        # Параметры MotionGate; None — модели работают на каждом кадре
+        self.motion = motion
+        self.gates = {}
+        self.last_detections = {}
+        # Параметры BudgetController по id камеры; None — полное качество на каждом кадре
+        self.budgets = budgets
+        self.controllers = {}
+
+    def controller(self, camera_id):
+        if self.budgets is None or camera_id not in self.budgets:
+            return None
+        if camera_id not in self.controllers:
+            self.controllers[camera_id] = BudgetController(**self.budgets[camera_id])
+        return self.controllers[camera_id]
+
+    def gate(self, packet):
+        if packet.camera_id not in self.last_detections:
+            return False
+        # Шаг контроллера задержки пропускает кадры независимо от движения
+        controller = self.controller(packet.camera_id)
+        if controller is not None and not controller.should_run():
+            return True
+        if self.motion is None:
+            return False
+        if packet.camera_id not in self.gates:
+            self.gates[packet.camera_id] = MotionGate(**self.motion)
+        return self.gates[packet.camera_id].decide(packet.frame) == REUSE
+
+    def settings(self, packet):
+        controller = self.controller(packet.camera_id)
+        return controller.settings() if controller is not None else InferenceSettings()
+
+    def measure(self, packet):
+        controller = self.controller(packet.camera_id)
+        if controller is None:
+            return
+        controller.update(time.time() - packet.timestamp)
+        BUDGET_LEVEL.set(controller.level, packet.camera_id)
+        BUDGET_LATENCY.set(round(controller.latency, 4), packet.camera_id)
+
+    def collect(self):
+        packets = [packet for packet in (frames.get(timeout=0) for frames in self.inputs) if packet is not None]
+        for packet in packets:
+            packet.reused = self.gate(packet)
+        return packets, [packet for packet in packets if not packet.reused]
+
+    def emit(self, packets, fresh, detections):
+        # detections — результаты для fresh, None — пачка потеряна (упал процесс инференса)
+        if detections is not None:
+            for packet, detection in zip(fresh, detections):
+                self.last_detections[packet.camera_id] = detection
+                self.measure(packet)
+        for packet in packets:
+            if packet.camera_id not in self.last_detections or (detections is None and not packet.reused):
+                continue
+            (FRAMES_REUSED if packet.reused else FRAMES_INFERRED).inc(packet.camera_id)
+            packet.detection = self.last_detections[packet.camera_id]
+            self.output.put(packet, timeout=self.poll_interval)
+
+    def step(self):
+        if self.pool is not None:
+            self.step_pooled()
+            return
+        packets, fresh = self.collect()
+        if not packets:
+            self.stop_event.wait(self.idle_wait)
+            return
+        detections = []
+        if fresh:
+            with INFERENCE_SECONDS.time():
+                detections = self.procv.detect_batch([packet.frame for packet in fresh],
+                                                     [self.settings(packet) for packet in fresh])
+        self.emit(packets, fresh, detections)
+
+    def emit_done(self):
+        # Результаты отдаются строго по порядку отправки, иначе трекер увидит кадры вразнобой
+        while self.pending and (self.pending[0][2] is None or self.pending[0][2].done()):
+            packets, fresh, future, started = self.pending.popleft()
+            detections = []
+            if future is not None:
+                try:
+                    detections = future.result()
+                    INFERENCE_SECONDS.observe(time.perf_counter() - started)
+                except Exception:
+                    logger.warning("Inference batch lost", exc_info=True)
+                    detections = None
+            self.emit(packets, fresh, detections)
+
+    def step_pooled(self):
+        self.emit_done()
+        busy = [future for _, _, future, _ in self.pending if future is not None]
+        if len(busy) >= self.pool.processes:
+            # Все процессы заняты: новые кадры не берём, в очередях захвата останутся самые свежие
+            wait(busy[:1], self.poll_interval)
+            return
+        packets, fresh = self.collect()
+        if not packets:
+            self.stop_event.wait(self.idle_wait)
+            return
+        future = None
+        if fresh:
+            try:
+                future = self.pool.submit([packet.frame for packet in fresh],
+                                          [self.settings(packet) for packet in fresh], timeout=self.poll_interval)
+            except ValueError:
+                self.fallback()
+                return
+            if future is None:
+                return  # свободный процесс не появился, кадры устарели
+        self.pending.append((packets, fresh, future, time.perf_counter()))
+        self.emit_done()
+
+    def fallback(self):
+        # Кадр камеры больше слота общей памяти (width/height в config.json меньше реального):
+        # пачка отбрасывается, дальше модели работают в этом потоке
+        logger.warning("Frames do not fit worker slots, falling back to in-process inference", exc_info=True)
+        self.teardown()
+        self.pool = None
+        self.procv.load()
+
+    def teardown(self):
+        # Дожидаемся пачек, которые уже считаются в процессах
+        if self.pending:
+            wait([future for _, _, future, _ in self.pending if future is not None], 5)
+            self.emit_done()
+            self.pending.clear()
+
+
+class RenderStage(Stage):
+    # Рисует разметку, ведёт треки людей и отдаёт кадры на показ и на сохранение
+    def __init__(self, procv, input, display, persist, tracking=None, display_size=None, overlay=False, clips=None):
+        super().__init__('render')
+        self.procv = procv
+        self.input = input
+        self.display = display
+        self.persist = persist
+        self.clips = clips  # ClipStage или None
+        self.display_size = display_size  # (ширина, высота) области показа, None — полный кадр
+        self.tracking = tracking or {}
+        self.trackers = {}
+        self.overlay = overlay  # подписать на кадре FPS, время инференса и задержку
+        self.fps = {}
+        self.last_render = {}
+
+    def draw_stats(self, packet, latency):
+        now = time.monotonic()
+        last = self.last_render.get(packet.camera_id)
+        self.last_render[packet.camera_id] = now
+        if last is not None and now > last:
+            # Сглаживаем, чтобы цифра не прыгала каждый кадр
+            self.fps[packet.camera_id] = 0.9 * self.fps.get(packet.camera_id, 1 / (now - last)) + 0.1 / (now - last)
+        inference = INFERENCE_SECONDS.last() or 0.0
+        lines = [f"{self.fps.get(packet.camera_id, 0.0):.1f} fps",
+                 f"inference {inference * 1000:.0f} ms",
+                 f"latency {latency * 1000:.0f} ms"]
+        for i, line in enumerate(lines):
+            cv2.putText(packet.display, line, (10, 24 + 22 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 1,
+                        cv2.LINE_AA)
+
+    def step(self):
+        packet = self.input.get(timeout=self.poll_interval)
+        if packet is None:
+            return
+        detection = packet.detection
+        # Разметка рисуется только на копии для показа, кадр для сохранения остаётся чистым
+        packet.evidence = packet.frame
+        packet.display = self.procv.paint(packet.frame, detection, self.display_size)
+        latency = time.time() - packet.timestamp
+        FRAME_LATENCY.observe(latency, packet.camera_id)
+        if self.overlay:
+            self.draw_stats(packet, latency)
+        # Повторно использованный результат уже учтён трекером на своём кадре
+        if not packet.reused:
+            if packet.camera_id not in self.trackers:
+                self.trackers[packet.camera_id] = Tracker(**self.tracking)
+            packet.actions = self.trackers[packet.camera_id].update(detection.people, detection.smokers,
+                                                                   packet.timestamp)
+            if len(detection.smoking):
+                DETECTIONS.inc(packet.camera_id, amount=len(detection.smoking))
+            for action in packet.actions:
+                EVENTS.inc(packet.camera_id, action.kind)
+            if packet.actions:
+                self.persist.put(packet, timeout=self.poll_interval)
+        if self.clips is not None:
+            tracker = self.trackers.get(packet.camera_id)
+            # Ролик продлевается только кадрами с курением: событие трекера остаётся открытым ещё end_after
+            # после последнего, а хвост в post_seconds отсчитывает сам ClipRecorder
+            packet.event_active = tracker is not None and any(track.event is not None and track.current
+                                                              for track in tracker.tracks)
+            self.clips.push(packet)
+        self.display.put(packet)
+
+    def teardown(self):
+        # Закрываем незавершённые события при остановке
+        for camera_id, tracker in self.trackers.items():
+            actions = tracker.flush()
+            for action in actions:
+                EVENTS.inc(camera_id, action.kind)
+            if actions:
+                packet = Packet(None, time.time(), 0, camera_id, actions=actions)
+                self.persist.put(packet)
+                if self.clips is not None:
+                    self.clips.push(packet)
+
+
+class PersistStage(Stage):
+    # Сохраняет события курения: запись события и ключевые кадры
+    def __init__(self, procv, input):
+        super().__init__('persist')
+        self.procv = procv
+        self.input = input
+
+    def save(self, packet):
+        for action in packet.actions:
+            self.procv.persist_event(packet.evidence, action, packet.camera_id, packet.timestamp)
+
+    def step(self):
+        packet = self.input.get(timeout=self.poll_interval)
+        if packet is None:
+            return
+        self.save(packet)
+
+    def teardown(self):
+        # Не теряем уже найденные кадры при остановке
+        packet = self.input.get(timeout=0)
+        while packet is not None:
+            self.save(packet)
+            packet = self.input.get(timeout=0)
+
+
+class ClipStage(Stage):
+    # Кольцевой буфер кадров каждой камеры и ролики эпизодов, см. clips.ClipRecorder.
+    # Кадры можно терять при отставании, события трекера — нет, поэтому они идут отдельно от очереди
+    def __init__(self, recorder, input):
+        super().__init__('clips')
+        self.recorder = recorder
+        self.input = input
+        self.triggers = deque()  # (id камеры, действия, время кадра)
+
+    def push(self, packet):
+        if packet.actions:
+            self.triggers.append((packet.camera_id, packet.actions, packet.timestamp))
+        if packet.frame is not None:
+            self.input.put(packet)
+
+    def apply_triggers(self):
+        while self.triggers:
+            camera_id, actions, timestamp = self.triggers.popleft()
+            for action in actions:
+                self.recorder.trigger(camera_id, action, timestamp)
+
+    def step(self):
+        packet = self.input.get(timeout=self.poll_interval)
+        self.apply_triggers()
+        if packet is not None:
+            self.recorder.add_frame(packet.camera_id, packet.frame, packet.timestamp, packet.event_active)
+        self.recorder.check(time.time())
+
+    def teardown(self):
+        # Дописываем начатые ролики: остаток очереди, затем закрытие
+        packet = self.input.get(timeout=0)
+        while packet is not None:
+            self.recorder.add_frame(packet.camera_id, packet.frame, packet.timestamp, packet.event_active)
+            packet = self.input.get(timeout=0)
+        self.apply_triggers()
+        self.recorder.close()
+
+
+def capture_api(name):
+    # 'dshow' -> cv2.CAP_DSHOW
+    return getattr(cv2, f'CAP_{name.upper()}')
+
+
+class Pipeline:
+    # capture (по камере) -> inference (общий батч) -> render -> (display, persist, clips)
+    def __init__(self, procv, cameras, queue_size=1, drop_policy=DROP_OLDEST,
+                 persist_queue_size=64, persist_policy=BLOCK, motion=None, tracking=None, display_size=None,
+                 overlay=False, budget=None, pool=None, clips=None):
+        self.procv = procv
+        self.frames = {camera['id']: FrameQueue(1, DROP_OLDEST) for camera in cameras}
+        # Очереди общие для всех камер, поэтому места хватает на кадр от каждой
+        self.detections = FrameQueue(queue_size * len(cameras), drop_policy)
+        self.output = FrameQueue(queue_size * len(cameras), drop_policy)
+        self.evidence = FrameQueue(persist_queue_size, persist_policy)
+        for camera_id, frames in self.frames.items():
+            self.watch(f'capture-{camera_id}', frames)
+        self.watch('detections', self.detections)
+        self.watch('output', self.output)
+        self.watch('evidence', self.evidence)
+        self.stages = [
+            CaptureStage(self.frames[camera['id']], camera['id'], camera.get('source', 0),
+                         capture_api(camera.get('api', 'any')),
+                         camera.get('width', 1920), camera.get('height', 1080))
+            for camera in cameras
+        ]
+        self.clips = None
+        if clips is not None and procv.writer is not None:
+            self.clip_frames = FrameQueue(8 * len(cameras), DROP_OLDEST)
+            self.watch('clips', self.clip_frames)
+            self.clips = ClipStage(ClipRecorder(procv.writer, **clips), self.clip_frames)
+        self.render = RenderStage(procv, self.detections, self.output, self.evidence, tracking, display_size,
+                                  overlay, self.clips)
+        self.stages += [
+            InferenceStage(procv, list(self.frames.values()), self.detections, motion,
+                           self.budgets(cameras, budget), pool),
+            self.render,
+            PersistStage(procv, self.evidence),
+        ]
+        # Последней: события роликов уже в очереди записи
+        if self.clips is not None:
+            self.stages.append(self.clips)
+
+    @classmethod
+    def from_config(cls, procv, config, display_size=None, pool=None):
+        motion = config['motion']
+        motion = {key: value for key, value in motion.items() if key != 'enabled'} if motion['enabled'] else None
+        budget = config['budget']
+        budget = {key: value for key, value in budget.items() if key != 'enabled'} if budget['enabled'] else None
+        clips = config['clips']
+        clips = {key: value for key, value in clips.items() if key != 'enabled'} if clips['enabled'] else None
+        return cls(procv, config['cameras'], motion=motion, tracking=config['tracking'], display_size=display_size,
+                   overlay=config['metrics']['overlay'], budget=budget, pool=pool, clips=clips, **config['pipeline'])
+
+    def budgets(self, cameras, budget):
+        # Общие границы из конфига, бюджет можно переопределить для камеры через budget_ms
+        if budget is None:
+            return None
+        return {camera['id']: dict(budget, target_ms=camera.get('budget_ms', budget['target_ms']))
+                for camera in cameras}
+
+    def watch(self, name, frames):
+        # Глубина очереди и потери читаются только при выгрузке метрик
+        QUEUE_DEPTH.set_function(frames.qsize, name)
+        FRAMES_DROPPED.set_function(lambda: frames.dropped, name)
+
+    def set_display_size(self, display_size):
+        self.render.display_size = display_size
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self, timeout=5):
+        # По порядку: каждая стадия успевает передать остаток следующей
+        for stage in self.stages:
+            stage.stop()
+            stage.join(timeout)
+        if self.procv.writer is not None:
+            self.procv.writer.flush(timeout)
+
+    def get(self, timeout=None):
+        return self.output.get(timeout)
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+
+from PySide6.QtCore import QObject, QRunnable, Signal
+from PySide6.QtGui import QImage
+
+from storage import read_bytes
+
+
+def pixmap_bytes(pixmap):
+    return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+
+class PixmapCache:
+    # LRU декодированных картинок с ограничением по объёму в байтах
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        pixmap = self.items.get(key)
+        if pixmap is not None:
+            self.items.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        if pixmap is None or pixmap.isNull():
+            return
+        if key in self.items:
+            self.size -= pixmap_bytes(self.items.pop(key))
+        self.items[key] = pixmap
+        self.size += pixmap_bytes(pixmap)
+        while self.size > self.max_bytes and len(self.items) > 1:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= pixmap_bytes(evicted)
+
+    def __contains__(self, key):
+        return key in self.items
+
+
+class ImageLoaderSignals(QObject):
+    loaded = Signal(str, QImage)  # path, image
+
+
+class ImageLoader(QRunnable):
+    # Декодирует картинку (файл или кадр из архива дня) в фоне; QPixmap делается уже в потоке интерфейса
+    def __init__(self, signals, path):
+        super().__init__()
+        self.signals = signals
+        self.path = path
+
+    def run(self):
+        self.signals.loaded.emit(self.path, QImage.fromData(read_bytes(self.path) or b''))
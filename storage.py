@@ -0,0 +1,296 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+
+from db import DB_PATH, migrate, next_day
+from metrics import STORAGE_BYTES, IMAGES_PACKED, IMAGES_EXPIRED
+
+
+logger = logging.getLogger(__name__)
+
+PACK_EXTENSION = '.pack'
+INDEX_EXTENSION = '.idx'
+
+
+def day_of(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def day_folder(root, camera_id, timestamp):
+    # Кадры раскладываются по дням: detected/cam_N/YYYY-MM-DD
+    return f'{root}/cam_{camera_id}/{day_of(timestamp)}'
+
+
+def archive_folder(root, camera_id):
+    return f'{root}/cam_{camera_id}/archive'
+
+
+def is_day(name):
+    try:
+        date.fromisoformat(name)
+    except ValueError:
+        return False
+    return True
+
+
+# Кадр в архиве дня записан в колонке path как 'архив.pack#смещение,размер,имя файла'
+def pack_locator(pack, offset, size, name):
+    return f'{pack}#{offset},{size},{name}'
+
+
+def parse_locator(path):
+    if f'{PACK_EXTENSION}#' not in path:
+        return None
+    pack, _, reference = path.rpartition('#')
+    offset, size, name = reference.split(',', 2)
+    return pack, int(offset), int(size), name
+
+
+def read_bytes(path):
+    # Содержимое кадра из отдельного файла или из архива дня; None — кадра нет
+    located = parse_locator(path)
+    try:
+        if located is None:
+            with open(path, 'rb') as file:
+                return file.read()
+        pack, offset, size, _ = located
+        with open(pack, 'rb') as file:
+            file.seek(offset)
+            data = file.read(size)
+    except OSError:
+        return None
+    return data if len(data) == size else None
+
+
+def display_name(path):
+    located = parse_locator(path)
+    return os.path.basename(path) if located is None else located[3]
+
+
+def append_pack(pack, files):
+    # files — [(ключ, путь)]. Дописывает кадры в конец архива дня, уже записанные смещения не меняются,
+    # поэтому читатели старых строк не замечают сжатия. Возвращает {ключ: локатор}
+    # Сначала читаем кадры: если не прочитался ни один, архив и индекс не создаются
+    frames = [(key, path, read_bytes(path)) for key, path in files]
+    frames = [(key, path, data) for key, path, data in frames if data is not None]
+    if not frames:
+        return {}
+    os.makedirs(os.path.dirname(pack), exist_ok=True)
+    index_path = pack[:-len(PACK_EXTENSION)] + INDEX_EXTENSION
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as file:
+            index = json.load(file)
+    locators = {}
+    with open(pack, 'ab') as out:
+        offset = out.seek(0, os.SEEK_END)
+        for key, path, data in frames:
+            out.write(data)
+            name = os.path.basename(path)
+            index[name] = [offset, len(data)]
+            locators[key] = pack_locator(pack, offset, len(data), name)
+            offset += len(data)
+        out.flush()
+        # Строки в базе переключаются на архив только после того, как он на диске
+        os.fsync(out.fileno())
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(index, file)
+    os.replace(tmp_path, index_path)
+    return locators
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return True
+    except OSError:
+        logger.warning("Cannot remove %s", path, exc_info=True)
+        return False
+
+
+class StorageMaintenance(threading.Thread):
+    # Фоновое обслуживание detected/: кадры старше compact_after_days переезжают в архив дня
+    # (cam_N/archive/YYYY-MM-DD.pack + .idx), кадры, события и ролики старше max_age_days
+    # и самые старые дни сверх max_bytes удаляются вместе со строками базы. 0 — без ограничения.
+    # У камеры можно задать свои 'retention_days' и 'retention_bytes'
+    def __init__(self, db_path=DB_PATH, root='detected', cameras=(), interval=3600, compact_after_days=2,
+                 max_age_days=0, max_bytes=0, thumbnails=None):
+        super().__init__(name='storage', daemon=True)
+        self.db_path = db_path
+        self.root = root
+        self.interval = interval
+        self.compact_after_days = max(1, compact_after_days)  # сегодняшний день всегда живой
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.policies = {camera['id']: (camera.get('retention_days', max_age_days),
+                                        camera.get('retention_bytes', max_bytes)) for camera in cameras}
+        self.thumbnails = thumbnails
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Storage maintenance failed")
+            if self.stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run_once(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            migrate(conn)
+            today = date.today()
+            cameras = {row[0] for row in conn.execute('SELECT DISTINCT id_camera FROM фотографии')}
+            thumbs = set()
+            for camera_id in sorted(cameras | set(self.policies)):
+                if self.stop_event.is_set():
+                    break
+                max_age_days, max_bytes = self.policies.get(camera_id, (self.max_age_days, self.max_bytes))
+                if max_age_days:
+                    thumbs |= self.expire(conn, camera_id, (today - timedelta(days=max_age_days)).isoformat())
+                self.compact(conn, camera_id, (today - timedelta(days=self.compact_after_days - 1)).isoformat())
+                thumbs |= self.trim(conn, camera_id, max_bytes, today.isoformat())
+            self.clean_thumbnails(conn, thumbs)
+        finally:
+            conn.close()
+
+    def compact(self, conn, camera_id, before):
+        # Живые кадры дней до before — в архивы по дням; выборка по индексу (id_camera, ts)
+        rows = conn.execute(f'''SELECT id, ts, path FROM фотографии
+                                WHERE id_camera = ? AND ts < ? AND path NOT LIKE '%{PACK_EXTENSION}#%'
+                                ORDER BY ts, id''', (camera_id, before)).fetchall()
+        for day, day_rows in itertools.groupby(rows, key=lambda row: row[1][:10]):
+            if self.stop_event.is_set():
+                return
+            day_rows = list(day_rows)
+            pack = f'{archive_folder(self.root, camera_id)}/{day}{PACK_EXTENSION}'
+            locators = append_pack(pack, [(row_id, path) for row_id, _, path in day_rows])
+            # Непрочитанные кадры (диск или сетевая папка могли быть недоступны) остаются как есть
+            # и попадут в архив на следующем проходе; удалять строки — дело expire
+            missing = [path for row_id, _, path in day_rows if row_id not in locators]
+            moved = {path: locators[row_id] for row_id, _, path in day_rows if row_id in locators}
+            with conn:
+                conn.executemany('UPDATE фотографии SET path = ? WHERE id = ?',
+                                 [(locator, row_id) for row_id, locator in locators.items()])
+                events = conn.execute('SELECT id, path FROM события WHERE id_camera = ? AND start >= ? AND start < ?',
+                                      (camera_id, day, next_day(day))).fetchall()
+                conn.executemany('UPDATE события SET path = ? WHERE id = ?',
+                                 [(moved[path], event_id) for event_id, path in events if path in moved])
+            folders = set()
+            for path in moved:
+                remove_file(path)
+                folders.add(os.path.dirname(path))
+            for folder in folders:
+                # Папку дня убираем, если в ней ничего не осталось (ролики дня остаются на месте)
+                if is_day(os.path.basename(folder)):
+                    try:
+                        os.rmdir(folder)
+                    except OSError:
+                        pass
+            IMAGES_PACKED.inc(camera_id, amount=len(locators))
+            if missing:
+                logger.warning("Camera %s, %s: %d frames cannot be read, left in place (first: %s)",
+                               camera_id, day, len(missing), missing[0])
+            if locators:
+                logger.info("Camera %s, %s: %d frames packed into %s", camera_id, day, len(locators), pack)
+
+    def expire(self, conn, camera_id, before):
+        # Всё по камере раньше дня before: файлы, архивы, ролики и строки. Возвращает ключи миниатюр
+        rows = conn.execute('SELECT path, thumb FROM фотографии WHERE id_camera = ? AND ts < ?',
+                            (camera_id, before)).fetchall()
+        clips = conn.execute('SELECT path FROM клипы WHERE id_camera = ? AND start < ?', (camera_id, before)).fetchall()
+        for path, _ in rows:
+            if parse_locator(path) is None:
+                remove_file(path)
+        for path, in clips:
+            remove_file(path)
+        with conn:
+            conn.execute('DELETE FROM фотографии WHERE id_camera = ? AND ts < ?', (camera_id, before))
+            conn.execute('DELETE FROM события WHERE id_camera = ? AND start < ?', (camera_id, before))
+            conn.execute('DELETE FROM клипы WHERE id_camera = ? AND start < ?', (camera_id, before))
+        archive = archive_folder(self.root, camera_id)
+        if os.path.isdir(archive):
+            for entry in os.scandir(archive):
+                day = entry.name.split('.', 1)[0]
+                if is_day(day) and day < before:
+                    remove_file(entry.path)
+        camera_folder = f'{self.root}/cam_{camera_id}'
+        if os.path.isdir(camera_folder):
+            for entry in os.scandir(camera_folder):
+                if entry.is_dir() and is_day(entry.name) and entry.name < before:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        if rows:
+            IMAGES_EXPIRED.inc(camera_id, amount=len(rows))
+            logger.info("Camera %s: %d frames before %s removed", camera_id, len(rows), before)
+        return {thumb for _, thumb in rows if thumb}
+
+    def usage(self, conn, camera_id):
+        # Байты по дням: архивы — по размеру файла, живые кадры — по stat (их мало, только последние дни),
+        # ролики — по колонке bytes
+        days = {}
+        archive = archive_folder(self.root, camera_id)
+        if os.path.isdir(archive):
+            for entry in os.scandir(archive):
+                day = entry.name.split('.', 1)[0]
+                if is_day(day):
+                    days[day] = days.get(day, 0) + entry.stat().st_size
+        for ts, path in conn.execute(f'''SELECT ts, path FROM фотографии
+                                         WHERE id_camera = ? AND path NOT LIKE '%{PACK_EXTENSION}#%' ''',
+                                     (camera_id,)):
+            try:
+                days[ts[:10]] = days.get(ts[:10], 0) + os.path.getsize(path)
+            except OSError:
+                pass
+        for day, size in conn.execute('''SELECT substr(start, 1, 10), SUM(bytes) FROM клипы
+                                         WHERE id_camera = ? GROUP BY 1''', (camera_id,)):
+            days[day] = days.get(day, 0) + (size or 0)
+        return days
+
+    def trim(self, conn, camera_id, max_bytes, today):
+        # Самые старые дни, пока камера не уложится в max_bytes; сегодняшний не трогаем
+        days = self.usage(conn, camera_id)
+        total = sum(days.values())
+        thumbs = set()
+        for day in sorted(days):
+            if not max_bytes or total <= max_bytes or day >= today:
+                break
+            thumbs |= self.expire(conn, camera_id, next_day(day))
+            total -= days[day]
+        STORAGE_BYTES.set(total, camera_id)
+        return thumbs
+
+    def clean_thumbnails(self, conn, keys):
+        # Миниатюры общие (ключ — sha1 кадра), удаляем только те, на которые больше нет строк
+        if self.thumbnails is None or not keys:
+            return
+        referenced = {row[0] for row in conn.execute('SELECT DISTINCT thumb FROM фотографии WHERE thumb IS NOT NULL')}
+        for key in keys - referenced:
+            remove_file(self.thumbnails.path_for(key))
+
+
+if __name__ == "__main__":
+    from config import load_config
+    from thumbnails import ThumbnailStore
+
+    parser = argparse.ArgumentParser(description="Сжатие и очистка папки detected по настройкам retention")
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--root', default='detected')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    config = load_config()
+    retention = {key: value for key, value in config['retention'].items() if key != 'enabled'}
+    StorageMaintenance(args.db, args.root, config['cameras'], thumbnails=ThumbnailStore(**config['thumbnails']),
+                       **retention).run_once()
@@ -0,0 +1,70 @@
+import hashlib
+import os
+
+import cv2
+import numpy as np
+
+from storage import read_bytes
+
+
+THUMBS_ROOT = 'detected/thumbs'
+
+
+def content_key(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class ThumbnailStore:
+    # Миниатюры кадров в папке detected/thumbs, имя файла — sha1 исходного JPEG,
+    # поэтому одна и та же картинка никогда не уменьшается дважды
+    def __init__(self, root=THUMBS_ROOT, width=480, quality=85):
+        self.root = root
+        self.width = width
+        self.quality = quality
+
+    def path_for(self, key):
+        # Подпапки по первым двум символам, чтобы не держать всё в одном каталоге
+        return f'{self.root}/{key[:2]}/{key}.jpg'
+
+    def write(self, image, key):
+        height, width = image.shape[:2]
+        if width > self.width:
+            size = (self.width, max(1, round(height * self.width / width)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return None
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'wb') as file:
+            file.write(buffer)
+        os.replace(tmp_path, path)
+        return path
+
+    def put(self, image, data):
+        # При сохранении кадра: image — исходный кадр, data — его JPEG
+        key = content_key(data)
+        if not os.path.exists(self.path_for(key)):
+            self.write(image, key)
+        return key
+
+    def ensure(self, image_path, key=None):
+        # Ленивая генерация для старых кадров; возвращает (путь миниатюры, ключ) или (None, None).
+        # Ключ нужно сохранить в фотографии.thumb, иначе исходный кадр будет читаться при каждом показе
+        if key and os.path.exists(self.path_for(key)):
+            return self.path_for(key), key
+        # Кадр может лежать и отдельным файлом, и в архиве дня
+        data = read_bytes(image_path)
+        if data is None:
+            return None, None
+        key = content_key(data)
+        path = self.path_for(key)
+        if os.path.exists(path):
+            return path, key
+        # Декодер JPEG сразу уменьшает в 4 раза, полный 1080p кадр не собирается
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_REDUCED_COLOR_4)
+        if image is None:
+            return None, None
+        path = self.write(image, key)
+        return (path, key) if path else (None, None)
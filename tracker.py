@@ -0,0 +1,177 @@
+import itertools
+from collections import deque
+from dataclasses import dataclass
+
+import numpy as np
+
+
+START = 'start'        # событие подтверждено: запись события и первый кадр
+KEYFRAME = 'keyframe'  # дополнительный кадр к уже начатому событию
+END = 'end'            # событие закончилось: обновить время конца и уверенность
+
+
+@dataclass
+class SmokingEvent:
+    track_id: int
+    start: float
+    end: float
+    confidence: float
+    keyframes: int = 0
+    last_keyframe: float = 0.0
+    record_id: int = None  # id записи в базе, проставляет PersistenceWriter после вставки START
+
+
+@dataclass
+class EventAction:
+    kind: str
+    event: SmokingEvent
+    box: np.ndarray = None
+
+
+@dataclass
+class Track:
+    track_id: int
+    box: np.ndarray
+    history: deque            # курит ли человек на последних M кадрах
+    hit_times: deque          # время кадров с курением внутри окна
+    missed: int = 0
+    event: SmokingEvent = None
+    current: bool = False     # курит ли на последнем кадре
+
+
+def iou_matrix(boxes_a, boxes_b):
+    # Попарный IoU двух наборов xyxy боксов
+    x_min = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y_min = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x_max = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y_max = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = (x_max - x_min).clip(min=0) * (y_max - y_min).clip(min=0)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter).clip(min=1e-6)
+
+
+def greedy_pairs(scores, valid):
+    # Жадное сопоставление: берём пары по убыванию score, каждая строка и столбец — один раз
+    rows, cols = np.nonzero(valid)
+    order = np.argsort(-scores[rows, cols], kind='stable')
+    used_rows, used_cols, pairs = set(), set(), []
+    for row, col in zip(rows[order], cols[order]):
+        if row not in used_rows and col not in used_cols:
+            used_rows.add(row)
+            used_cols.add(col)
+            pairs.append((row, col))
+    return pairs
+
+
+class Tracker:
+    # Трекер людей по боксам позы (IoU, затем расстояние между центрами)
+    # и превращение покадровых детекций в события курения
+    def __init__(self, iou_threshold=0.3, max_distance=0.5, max_missed=15,
+                 window=10, confirm_hits=5, keyframes=3, keyframe_interval=5.0, end_after=60.0):
+        self.iou_threshold = iou_threshold
+        self.max_distance = max_distance        # доля диагонали бокса трека
+        self.max_missed = max_missed            # кадров без сопоставления до удаления трека
+        self.window = window                    # M — длина окна
+        self.confirm_hits = confirm_hits        # N — сколько кадров с курением в окне нужно
+        self.keyframes = keyframes              # сколько кадров сохранять на событие
+        self.keyframe_interval = keyframe_interval  # секунд между ключевыми кадрами
+        # Секунд без курения до конца события. Считается по времени, а не по кадрам: частота инференса
+        # зависит от детектора движения и бюджета, а между затяжками рука долго опущена
+        self.end_after = end_after
+        self.tracks = []
+        self.ids = itertools.count(1)
+
+    def match(self, boxes):
+        if not self.tracks or len(boxes) == 0:
+            return []
+        track_boxes = np.stack([track.box for track in self.tracks])
+        iou = iou_matrix(track_boxes, boxes)
+        pairs = greedy_pairs(iou, iou >= self.iou_threshold)
+
+        # Для оставшихся — ближайший центр, если человек сдвинулся сильнее, чем ловит IoU
+        free_tracks = np.setdiff1d(np.arange(len(track_boxes)), [row for row, _ in pairs])
+        free_boxes = np.setdiff1d(np.arange(len(boxes)), [col for _, col in pairs])
+        if len(free_tracks) and len(free_boxes):
+            centres_t = (track_boxes[free_tracks, :2] + track_boxes[free_tracks, 2:]) / 2
+            centres_b = (boxes[free_boxes, :2] + boxes[free_boxes, 2:]) / 2
+            distance = np.linalg.norm(centres_t[:, None] - centres_b[None], axis=-1)
+            diagonal = np.linalg.norm(track_boxes[free_tracks, 2:] - track_boxes[free_tracks, :2], axis=-1)
+            distance = distance / diagonal[:, None].clip(min=1e-6)
+            pairs += [(free_tracks[row], free_boxes[col])
+                      for row, col in greedy_pairs(-distance, distance <= self.max_distance)]
+        return pairs
+
+    def push(self, track, smoking, timestamp):
+        track.current = smoking
+        track.history.append(bool(smoking))
+        if smoking:
+            track.hit_times.append(timestamp)
+        while track.hit_times and len(track.hit_times) > sum(track.history):
+            track.hit_times.popleft()
+
+    def evaluate(self, track, timestamp):
+        hits = int(sum(track.history))
+        confidence = hits / self.window
+        event = track.event
+        if event is None:
+            if hits >= self.confirm_hits:
+                track.event = SmokingEvent(track.track_id, track.hit_times[0], timestamp, confidence,
+                                           keyframes=1, last_keyframe=timestamp)
+                return [EventAction(START, track.event, track.box.copy())]
+            return []
+
+        if not track.current and timestamp - event.end >= self.end_after:
+            track.event = None
+            return [EventAction(END, event)]
+        event.confidence = max(event.confidence, confidence)
+        if track.current:
+            event.end = timestamp
+            if (event.keyframes < self.keyframes
+                    and timestamp - event.last_keyframe >= self.keyframe_interval):
+                event.keyframes += 1
+                event.last_keyframe = timestamp
+                return [EventAction(KEYFRAME, event, track.box.copy())]
+        return []
+
+    def update(self, boxes, smokers, timestamp):
+        # boxes: (P, 4) xyxy люди на кадре, smokers: индексы курящих в boxes
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        smoking = np.zeros(len(boxes), dtype=bool)
+        smoking[np.asarray(smokers, dtype=np.int64)] = True
+
+        pairs = self.match(boxes)
+        matched_tracks = {row for row, _ in pairs}
+        matched_boxes = {col for _, col in pairs}
+        for row, col in pairs:
+            track = self.tracks[row]
+            track.box = boxes[col]
+            track.missed = 0
+            self.push(track, smoking[col], timestamp)
+        for row, track in enumerate(self.tracks):
+            if row not in matched_tracks:
+                track.missed += 1
+                self.push(track, False, timestamp)
+        for col in range(len(boxes)):
+            if col not in matched_boxes:
+                track = Track(next(self.ids), boxes[col], deque(maxlen=self.window), deque())
+                self.push(track, smoking[col], timestamp)
+                self.tracks.append(track)
+
+        actions = []
+        alive = []
+        for track in self.tracks:
+            if track.missed > self.max_missed:
+                if track.event is not None:
+                    actions.append(EventAction(END, track.event))
+                continue
+            actions += self.evaluate(track, timestamp)
+            alive.append(track)
+        self.tracks = alive
+        return actions
+
+    def flush(self):
+        # Закрыть все начатые события, например при остановке видео
+        actions = [EventAction(END, track.event) for track in self.tracks if track.event is not None]
+        self.tracks = []
+        return actions
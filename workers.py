@@ -0,0 +1,245 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from metrics import WORKER_RESTARTS, WORKERS_BUSY
+
+
+logger = logging.getLogger(__name__)
+
+_READY = 'ready'
+_FAILED = 'failed'
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+def slot_bytes(cameras):
+    # Самый большой кадр из настроек камер
+    return max(camera.get('width', 1920) * camera.get('height', 1080) * 3 for camera in cameras)
+
+
+def worker_main(index, shm_name, slot_size, tasks, results, options):
+    # Процесс инференса: свой ProcVideo с моделями, кадры читает из общей памяти без копирования
+    import cv2
+    from alg import ProcVideo
+    cv2.setNumThreads(options['threads'])
+    try:
+        procv = ProcVideo(models=dict(options['models'], threads=options['threads']), **options['detector'])
+    except Exception:
+        results.put((_FAILED, index, traceback.format_exc()))
+        return
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffer = np.ndarray((shm.size,), dtype=np.uint8, buffer=shm.buf)
+    results.put((_READY, index, None))
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            task_id, frames, settings = task
+            images = [buffer[slot * slot_size:slot * slot_size + int(np.prod(shape))].reshape(shape)
+                      for slot, shape in frames]
+            try:
+                detections = procv.detect_batch(images, settings)
+            except Exception:
+                results.put((task_id, index, traceback.format_exc()))
+                continue
+            finally:
+                del images
+            # Detection — только небольшие массивы ключевых точек и боксов
+            results.put((task_id, index, detections))
+    finally:
+        del buffer
+        shm.close()
+
+
+class WorkerPool:
+    # Процессы инференса. Кадры передаются через кольцо слотов в multiprocessing.shared_memory,
+    # обратно приходят только результаты. Упавший процесс перезапускается, его пачка завершается ошибкой
+    def __init__(self, processes=2, threads=2, slots=None, slot_size=1920 * 1080 * 3, models=None,
+                 detector=None, poll_interval=0.5):
+        self.processes = processes
+        self.slot_size = slot_size
+        self.slots = slots or processes * 2
+        self.options = {'threads': threads, 'models': models or {}, 'detector': detector or {}}
+        self.poll_interval = poll_interval
+        self.context = multiprocessing.get_context('spawn')  # fork вместе с потоками Qt небезопасен
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * slot_size)
+        self.buffer = np.ndarray((self.shm.size,), dtype=np.uint8, buffer=self.shm.buf)
+        self.free_slots = queue.Queue()
+        for slot in range(self.slots):
+            self.free_slots.put(slot)
+        self.idle = queue.Queue()  # (индекс, поколение) готовых к работе процессов
+        self.generations = [0] * processes  # растёт при перезапуске, старые записи в idle отбрасываются
+        self.loaded = [False] * processes
+        self.results = self.context.Queue()
+        self.workers = [None] * processes
+        self.tasks = [None] * processes
+        self.in_flight = {}  # индекс процесса -> (task_id, слоты, future)
+        self.lock = threading.Lock()
+        self.task_ids = iter(range(1, 2 ** 62))
+        self.ready_count = 0
+        self.ready = threading.Event()
+        self.error = None
+        self.closed = False
+        for index in range(processes):
+            self.spawn(index)
+        self.collector = threading.Thread(target=self.collect, name='worker-results', daemon=True)
+        self.collector.start()
+
+    def spawn(self, index):
+        self.loaded[index] = False
+        self.tasks[index] = self.context.Queue()
+        process = self.context.Process(target=worker_main, name=f'inference-{index}', daemon=True,
+                                       args=(index, self.shm.name, self.slot_size, self.tasks[index],
+                                             self.results, self.options))
+        process.start()
+        self.workers[index] = process
+
+    def wait_ready(self, timeout=None):
+        # Для ModelLoader: все процессы загрузили и прогрели модели
+        if not self.ready.wait(timeout):
+            return False
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return True
+
+    def submit(self, images, settings=None, timeout=None):
+        # Ждёт свободный процесс: это и есть ограничение числа пачек в работе.
+        # None — за timeout никто не освободился
+        while True:
+            try:
+                index, generation = self.idle.get(timeout=timeout)
+                while generation != self.generations[index]:
+                    index, generation = self.idle.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            slots, frames = self.copy_frames(images, index, generation)
+            future = Future()
+            task_id = next(self.task_ids)
+            with self.lock:
+                # Пока копировались кадры, процесс мог упасть и перезапуститься: новый процесс сам встанет
+                # в idle после готовности, а процессу с пачкой в работе вторая не отдаётся
+                if generation == self.generations[index] and index not in self.in_flight:
+                    self.in_flight[index] = (task_id, slots, future)
+                    WORKERS_BUSY.set(len(self.in_flight))
+                    self.tasks[index].put((task_id, frames, None if settings is None else list(settings)))
+                    return future
+            self.release(slots)
+
+    def copy_frames(self, images, index, generation):
+        # Кадры в свободные слоты общей памяти; при ошибке слоты и процесс возвращаются обратно
+        slots = []
+        frames = []
+        try:
+            for image in images:
+                if image.nbytes > self.slot_size:
+                    raise ValueError(f"Frame {image.shape} does not fit into a {self.slot_size} byte slot")
+                slot = self.free_slots.get()
+                slots.append(slot)
+                start = slot * self.slot_size
+                np.copyto(self.buffer[start:start + image.nbytes].reshape(image.shape), image)
+                frames.append((slot, image.shape))
+        except Exception:
+            self.release(slots)
+            self.idle.put((index, generation))
+            raise
+        return slots, frames
+
+    def release(self, slots):
+        for slot in slots:
+            self.free_slots.put(slot)
+
+    def finish(self, index, task_id, detections):
+        with self.lock:
+            task = self.in_flight.get(index)
+            if task is None or task[0] != task_id:
+                return
+            del self.in_flight[index]
+            generation = self.generations[index]
+            WORKERS_BUSY.set(len(self.in_flight))
+        _, slots, future = task
+        self.release(slots)
+        self.idle.put((index, generation))
+        if isinstance(detections, str):
+            future.set_exception(RuntimeError(f"Inference failed in worker {index}:\n{detections}"))
+        else:
+            future.set_result(detections)
+
+    def collect(self):
+        while not self.closed:
+            try:
+                message = self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                message = None
+            except (EOFError, OSError):
+                break
+            if message is not None:
+                self.handle(*message)
+            self.supervise()
+
+    def handle(self, kind, index, payload):
+        if kind == _READY:
+            self.loaded[index] = True
+            self.ready_count += 1
+            self.idle.put((index, self.generations[index]))
+            if self.ready_count >= self.processes:
+                self.ready.set()
+        elif kind == _FAILED:
+            # Модели не грузятся — перезапуск не поможет
+            logger.error("Inference worker %d failed to load models:\n%s", index, payload)
+            self.error = payload
+            self.ready.set()
+        else:
+            self.finish(index, kind, payload)
+
+    def supervise(self):
+        if self.closed or self.error is not None:
+            return
+        for index, process in enumerate(self.workers):
+            if process.is_alive():
+                continue
+            logger.error("Inference worker %d exited with code %s, restarting", index, process.exitcode)
+            WORKER_RESTARTS.inc()
+            # Поколение меняется под lock вместе со снятием пачки: submit сверяет его перед тем,
+            # как отдать пачку процессу, и старому процессу новых пачек уже не достанется
+            with self.lock:
+                task = self.in_flight.pop(index, None)
+                self.generations[index] += 1
+                WORKERS_BUSY.set(len(self.in_flight))
+            if task is not None:
+                _, slots, future = task
+                self.release(slots)
+                future.set_exception(WorkerCrashed(f"Inference worker {index} crashed"))
+            # Новый процесс попадёт в idle после сообщения о готовности
+            if self.loaded[index]:
+                self.ready_count -= 1
+            self.spawn(index)
+
+    def close(self, timeout=5):
+        if self.closed:
+            return
+        self.closed = True
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.workers:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.collector.join(timeout)
+        with self.lock:
+            for _, _, future in self.in_flight.values():
+                if not future.done():
+                    future.set_exception(WorkerCrashed("Worker pool closed"))
+            self.in_flight.clear()
+        del self.buffer
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,228 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from db import DB_PATH, migrate
+from metrics import IMAGES_SAVED, ENCODE_SECONDS, DB_ROWS, DB_ERRORS, DB_WRITE_LAG, DB_QUEUE_DEPTH
+from storage import day_folder
+from thumbnails import ThumbnailStore
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def format_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def format_timestamp(timestamp):
+    # Формат колонки фотографии.ts, сортируется как строка
+    return datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='microseconds')
+
+
+class PersistenceWriter:
+    # Фоновая запись детекций: JPEG кодируются в небольшом пуле потоков,
+    # строки в базу пишет один поток с долгоживущим соединением пачками
+    def __init__(self, db_path=DB_PATH, root='detected', batch_size=100, batch_interval=1.0,
+                 encode_workers=2, jpeg_quality=95, thumbnails=None):
+        self.db_path = db_path
+        self.root = root
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval  # секунд между коммитами
+        self.jpeg_quality = jpeg_quality
+        # Миниатюры для галереи делаем сразу, пока кадр ещё в памяти
+        self.thumbnails = thumbnails if thumbnails is not None else ThumbnailStore(f'{root}/thumbs')
+        self.queue = queue.Queue()
+        DB_QUEUE_DEPTH.set_function(self.queue.qsize)
+        self.encoder = ThreadPoolExecutor(encode_workers, thread_name_prefix='jpeg')
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.folders = set()
+        self.counter = itertools.count()
+        self.closed = False
+
+        conn = sqlite3.connect(self.db_path)
+        migrate(conn)
+        conn.close()
+
+        self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+        self.thread.start()
+
+    def folder(self, camera_id, timestamp=None):
+        # Папка дня камеры, см. storage.day_folder; старые дни сжимает storage.StorageMaintenance
+        cam_folder = day_folder(self.root, camera_id, time.time() if timestamp is None else timestamp)
+        if cam_folder not in self.folders:
+            os.makedirs(cam_folder, exist_ok=True)
+            self.folders.add(cam_folder)
+        return cam_folder
+
+    def unique_name(self, timestamp):
+        # Время с микросекундами плюс счётчик — без проверок os.path.exists
+        now = datetime.fromtimestamp(timestamp)
+        return f'{now.strftime("%Y-%m-%d_%H-%M-%S")}_{now.microsecond:06d}_{next(self.counter) % 10000:04d}.jpg'
+
+    def encode(self, image, path, record, camera_id=None):
+        with ENCODE_SECONDS.time():
+            ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                logger.error("Failed to encode %s", path)
+                return
+            with open(path, 'wb') as file:
+                file.write(buffer)
+        IMAGES_SAVED.inc(camera_id)
+        thumb = self.thumbnails.put(image, buffer) if self.thumbnails else None
+        # Строка появляется в базе только после того, как файл записан
+        if record is not None:
+            self.add_record(*record, thumb=thumb)
+
+    def new_path(self, camera_id, timestamp):
+        return f'{self.folder(camera_id, timestamp)}/{self.unique_name(timestamp)}'
+
+    def save_image(self, image, camera_id, timestamp=None, record=True, boxes=None, confidence=None,
+                   event_id=None, event=None, path=None):
+        # Возвращает путь сразу, сам файл пишется в пуле. path — заранее выданный new_path
+        timestamp = time.time() if timestamp is None else timestamp
+        path = path or self.new_path(camera_id, timestamp)
+        record = (camera_id, path, timestamp, boxes, confidence, event_id, event) if record else None
+        future = self.encoder.submit(self.encode, image, path, record, camera_id)
+        with self.pending_lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return path
+
+    def done(self, future):
+        with self.pending_lock:
+            self.pending.discard(future)
+        if future.exception() is not None:
+            logger.error("Failed to save image", exc_info=future.exception())
+
+    def execute(self, sql, params, inserted=None):
+        # params может быть функцией — тогда параметры берутся в потоке записи, когда строка события
+        # уже вставлена (см. add_event). inserted(lastrowid) вызывается после выполнения запроса
+        self.queue.put((sql, params, time.monotonic(), inserted))
+
+    def add_record(self, camera_id, image_path, timestamp=None, boxes=None, confidence=None, event_id=None,
+                   event=None, thumb=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        if boxes is not None:
+            boxes = json.dumps(np.asarray(boxes, dtype=np.float32).reshape(-1, 4).round(1).tolist())
+        row = (camera_id, format_timestamp(timestamp), image_path, boxes,
+               None if confidence is None else float(confidence))
+        params = (*row, event_id, thumb)
+        if event is not None:
+            def params():
+                return (*row, event.record_id, thumb)
+        self.execute('''INSERT INTO фотографии (id_camera, ts, path, boxes, confidence, event_id, thumb)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''', params)
+
+    def add_event(self, camera_id, event, image_path, source=None):
+        # id события выдаёт SQLite: в одну базу могут писать окно и batch.py одновременно.
+        # record_id появляется после вставки, строки кадров и обновления берут его уже в потоке записи,
+        # поэтому add_event нужно вызывать раньше, чем они попадут в очередь. source — файл для batch.py
+        self.execute('''INSERT INTO события (id_camera, track_id, start, end, confidence, path, source)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                     (camera_id, event.track_id, format_datetime(event.start), format_datetime(event.end),
+                      event.confidence, image_path, source),
+                     lambda row_id: setattr(event, 'record_id', row_id))
+
+    def update_event(self, event):
+        end, confidence = format_datetime(event.end), event.confidence
+        self.execute('''UPDATE события SET end = ?, confidence = ? WHERE id = ?''',
+                     lambda: (end, confidence, event.record_id))
+
+    def add_clip(self, camera_id, path, start, end, event=None, frames=None, size=None):
+        row = (camera_id, format_timestamp(start), format_timestamp(end), path, frames, size)
+        self.execute('''INSERT INTO клипы (id_camera, start, end, path, frames, bytes, event_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                     lambda: (*row, None if event is None else event.record_id))
+
+    def run_statement(self, conn, item):
+        sql, params, _, inserted = item
+        cursor = conn.execute(sql, params() if callable(params) else params)
+        if inserted is not None:
+            inserted(cursor.lastrowid)
+
+    def commit(self, conn, batch):
+        if not batch:
+            return
+        try:
+            with conn:
+                for item in batch:
+                    self.run_statement(conn, item)
+            written = list(batch)
+        except sqlite3.Error:
+            # Пачка откатилась целиком; повторяем по одной строке, чтобы терять только сбойные
+            logger.warning("Failed to write %d rows in one transaction, retrying one by one", len(batch),
+                           exc_info=True)
+            written = []
+            for item in batch:
+                try:
+                    with conn:
+                        self.run_statement(conn, item)
+                except sqlite3.Error:
+                    DB_ERRORS.inc()
+                    logger.exception("Failed to write row: %s", ' '.join(item[0].split()[:3]))
+                else:
+                    written.append(item)
+        DB_ROWS.inc(amount=len(written))
+        now = time.monotonic()
+        for _, _, enqueued, _ in written:
+            DB_WRITE_LAG.observe(now - enqueued)
+        batch.clear()
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        batch = []
+        deadline = time.monotonic() + self.batch_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self.commit(conn, batch)
+                break
+            if isinstance(item, threading.Event):
+                # flush(): всё, что было в очереди до маркера, уже в batch
+                self.commit(conn, batch)
+                item.set()
+                continue
+            if item is not None:
+                batch.append(item)
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self.commit(conn, batch)
+                deadline = time.monotonic() + self.batch_interval
+        conn.close()
+
+    def flush(self, timeout=None):
+        # Дождаться записи всех картинок и закоммитить все строки
+        with self.pending_lock:
+            pending = list(self.pending)
+        wait(pending, timeout)
+        marker = threading.Event()
+        self.queue.put(marker)
+        return marker.wait(timeout)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.encoder.shutdown(wait=True)
+        self.queue.put(_STOP)
+        self.thread.join()